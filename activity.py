@@ -1,10 +1,23 @@
 # Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
 # SPDX-License-Identifier: MIT
 
+import threading
+import time
+
+import tracing
+
+# Period to ask for when an activity needs ticking every frame
+FRAME_PERIOD = 1.0 / 24
+
 class Activity():
     def __init__(self):
         pass
 
+    # Time (as time.time()) by which onDraw() needs calling again even if
+    # there's no input, or None to sleep until the next input event.
+    def nextDeadline(self):
+        return None
+
     def onResume(self):
         pass
 
@@ -20,6 +33,16 @@ class Activity():
     def onExit(self):
         pass
 
+    # Whether the activity has nothing time-critical going on, so that
+    # the others can get on with background work.
+    def idle(self):
+        return True
+
+    # Called on the activities which aren't showing, while the current
+    # one is idle(). Should only start work, not wait for it.
+    def onIdle(self):
+        pass
+
 class ActivityManager():
     def __init__(self):
         self.activities = { }
@@ -28,21 +51,55 @@ class ActivityManager():
     def register(self, name, activity):
         self.activities[name] = activity
 
+    # Construct an activity in the background. It's waited for the first
+    # time it's started (or on exit).
+    def registerAsync(self, name, factory):
+        pending = {}
+        def build():
+            with tracing.span('startup.' + name):
+                pending['activity'] = factory()
+        thread = threading.Thread(target=build, daemon=True)
+        thread.start()
+        self.activities[name] = (thread, pending)
+
+    def get(self, name):
+        activity = self.activities[name]
+        if isinstance(activity, tuple):
+            thread, pending = activity
+            thread.join()
+            activity = pending['activity']
+            self.activities[name] = activity
+        return activity
+
     def start(self, name):
         if self.current is not None:
             self.current.onPause()
-        self.current = self.activities[name]
+        self.current = self.get(name)
         self.current.onResume()
 
     def stop(self):
         self.current.onPause()
 
     def exit(self):
-        for name, activity in self.activities.items():
-            activity.onExit()
+        for name in list(self.activities.keys()):
+            self.get(name).onExit()
+
+    def nextDeadline(self):
+        return self.current.nextDeadline()
 
     def tick(self, events):
+        start = time.time()
+        for event in events:
+            if 'time' in event:
+                tracing.record('input.latency', event['time'], start)
+
         new = self.current.onInputReceived(events)
         self.current.onDraw()
         if new is not None:
             self.start(new)
+        if self.current.idle():
+            for activity in self.activities.values():
+                # Ones which are still being built can wait
+                if activity is not self.current and isinstance(activity, Activity):
+                    activity.onIdle()
+        tracing.record('tick', start)
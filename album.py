@@ -1,60 +1,624 @@
 # Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
 # SPDX-License-Identifier: MIT
 
+import concurrent.futures
+import functools
+import io
 import os
-import shutil
+import queue
 import datetime
-import glob
+import re
+import threading
 
 from PIL import Image
 
+import decode
+import layout
+import replication
+import tracing
+
+from consts import RENDITIONS
+
+# Frames captured straight to JPEG carry the encoded data, which can be
+# written out as-is.
+def encoded(frame):
+    return getattr(frame, 'encoded', None)
+
+def composite(frames, template = None):
+    if len(frames) == 1:
+        return frames[0]
+    if template is None:
+        template = layout.TEMPLATES['2x2']
+    if len(frames) != len(template):
+        print("Unexpected number of frames {}".format(len(frames)))
+        return None
+    collage = layout.Collage(template, frames[0].size)
+    for f in frames:
+        collage.add(f)
+    return collage.result()
+
+# Cheap reduced-size version of what writeOut() will produce, so that
+# the result can be reviewed before the full-size encode has finished.
+def preview(frames, size, template = None):
+    if len(frames) == 1:
+        frame = frames[0]
+        data = encoded(frame)
+        if data is not None:
+            # A separate, reduced decode: drafting the frame itself would
+            # shrink what gets saved.
+            frame = decode.reduce(Image.open(io.BytesIO(data)), size)
+        return frame.resize(decode.fit(frame.size, size))
+
+    # The same layout, with the frames scaled down so it fits in size
+    if template is None:
+        template = layout.TEMPLATES['2x2']
+    canvas = template.canvasSize(frames[0].size)
+    scale = min(size[0] / canvas[0], size[1] / canvas[1])
+    small = (int(frames[0].size[0] * scale), int(frames[0].size[1] * scale))
+    canvas = composite([f.resize(small) for f in frames], template)
+    if canvas is None:
+        return None
+    return canvas.resize(decode.fit(canvas.size, size))
+
+# Where a file is written before it's renamed into place
+def temp_path(filename):
+    directory, base = os.path.split(filename)
+    return os.path.join(directory, '.' + base + '.tmp')
+
+# Whether a file got all the way to its end marker. Enough to catch the
+# ones which were cut short, without decoding anything.
+def complete(filename):
+    trailers = { '.jpg': b'\xff\xd9', '.gif': b'\x3b' }
+    trailer = trailers.get(os.path.splitext(filename)[1].lower())
+    if trailer is None:
+        return True
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < len(trailer):
+            return False
+        f.seek(-len(trailer), os.SEEK_END)
+        return f.read() == trailer
+
+# Index entries are paths relative to the album directory, which may be
+# in a shard subdirectory. They're ordered by filename, which starts
+# with the capture time, whichever shard they're in.
+def sort_key(name):
+    return os.path.basename(name)
+
+# First position in names (sorted by sort_key) whose key isn't below key
+def search(names, key):
+    lo, hi = 0, len(names)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if sort_key(names[mid]) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+# Read-only, newest-first view of the index at the time it was taken.
+# Entries are only resolved to paths when they're asked for.
+class AlbumList:
+    def __init__(self, directory, names, count):
+        self.directory = directory
+        self.names = names
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.count))]
+        if idx < 0:
+            idx += self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError("album index out of range")
+        return os.path.join(self.directory, self.names[self.count - 1 - idx])
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def page(self, start, count):
+        return self[start:start + count]
+
+# Append-only log of the files in the album, oldest first. It's rebuilt
+# from the directory whenever the directory, or one of its shards, has
+# changed behind its back.
+class AlbumIndex:
+    def __init__(self, directory, exts):
+        self.directory = os.path.abspath(directory)
+        self.exts = exts
+        self.path = os.path.join(self.directory, '.index')
+        self.lock = threading.Lock()
+        self.names = []
+
+        if self.stale():
+            self.rebuild()
+        else:
+            self.load()
+
+    # (directory, filenames) for the album directory and every shard
+    # under it, however deeply nested. Hidden ones (like renditions)
+    # aren't shards.
+    def walk(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            yield root, files
+
+    def stale(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            return any(mtime < os.stat(root).st_mtime for root, files in self.walk())
+        except FileNotFoundError:
+            return True
+
+    def load(self):
+        with open(self.path) as f:
+            names = set(l.strip() for l in f)
+        names.discard('')
+        self.names = sorted(names, key=sort_key)
+
+    def rebuild(self):
+        exts = tuple('.' + ext for ext in self.exts)
+        names = []
+        for root, files in self.walk():
+            names += [os.path.relpath(os.path.join(root, f), self.directory) for f in files
+                    if f.endswith(exts) and not f.startswith('.')]
+        self.names = sorted(names, key=sort_key)
+        with open(self.path + '.tmp', 'w') as f:
+            for name in self.names:
+                f.write(name + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        # The rename bumped the directory mtime
+        self.touch()
+
+    # Mark the index as up to date with the directory, after changing
+    # something in it which isn't a picture.
+    def touch(self):
+        os.utime(self.path)
+
+    def add(self, filename):
+        name = os.path.relpath(os.path.abspath(filename), self.directory)
+        key = sort_key(name)
+        with self.lock:
+            if len(self.names) == 0 or key > sort_key(self.names[-1]):
+                self.names.append(name)
+            elif name not in self.names:
+                # Out-of-order insert: copy, so existing views stay valid
+                names = list(self.names)
+                names.insert(search(names, key), name)
+                self.names = names
+            else:
+                return
+            with open(self.path, 'a') as f:
+                f.write(name + '\n')
+
+    def view(self):
+        with self.lock:
+            return AlbumList(self.directory, self.names, len(self.names))
+
+    # Up to count files older than cursor (or the newest, for None),
+    # newest first, and the cursor for the page after. Unlike offsets,
+    # cursors aren't disturbed by new files being added.
+    def after(self, cursor, count):
+        with self.lock:
+            names = self.names
+        end = len(names) if cursor is None else search(names, sort_key(cursor))
+        start = max(0, end - count)
+        page = [os.path.join(self.directory, n) for n in reversed(names[start:end])]
+        return page, (names[start] if start > 0 else None)
+
 class Album:
-    def __init__(self, directory, backup = None):
+    # New files go into a subdirectory per shard, named by formatting the
+    # capture time (UTC) with shard, e.g. one per day by default. It can
+    # be nested, like '%Y/%m/%d'. None keeps everything in directory.
+    #
+    # Files are written to a temporary name and renamed into place. With
+    # fsync 'file', each one is synced before the rename. With 'batch',
+    # they're synced fsync_batch at a time, or after fsync_interval
+    # seconds, so a power cut can lose the last few, though recovery
+    # will quarantine any which were left incomplete. None leaves it to
+    # the OS.
+    def __init__(self, directory, backup = None, workers = 1, max_pending = 2, postprocess = None,
+            shard = '%Y-%m-%d', fsync = 'file', fsync_batch = 8, fsync_interval = 5.0):
         self.directory = directory
+        self.shard = shard
+        self.fsync = fsync
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.sync_lock = threading.Lock()
+        self.unsynced = []
+        self.sync_timer = None
+        # postprocess.Pipeline applied to each frame before compositing
+        self.postprocess = postprocess
         self.ext = 'jpg'
+        self.animation_ext = 'gif'
         try:
             os.mkdir(self.directory)
         except FileExistsError:
             pass
 
+        self.index = AlbumIndex(self.directory, [self.ext, self.animation_ext])
+        self.listeners = []
+
+        # Says 'open' while the album is in use, so a crash can be
+        # detected. It's rewritten in place rather than created and
+        # removed, which would make the index look stale.
+        self.marker = os.path.join(self.directory, '.state')
+        with tracing.span('album.recover'):
+            if self.recover() > 0:
+                self.index.rebuild()
+
         self.backup = backup
+        self.replicator = None
         if self.backup is not None:
             try:
                 os.mkdir(self.backup)
             except FileExistsError:
                 pass
+            self.replicator = replication.Replicator(self.directory, self.backup,
+                    os.path.join(self.directory, '.replication'))
 
-    def writeOut(self, frames):
-            filename = self.genFilename()
-            if len(frames) == 1:
-                frames[0].save(filename, 'jpeg')
-            elif len(frames) == 4:
-                size = frames[0].size
-                points = [
-                    (0, 0),
-                    (size[0], 0),
-                    (0, size[1]),
-                    size,
-                ]
-                canvas = Image.new('RGBA', (size[0] * 2, size[1] * 2), (255, 255, 255, 255))
-                for i in range(len(points)):
-                    canvas.paste(frames[i], points[i])
-                canvas.save(filename, 'jpeg')
-                canvas.close()
-            else:
-                print("Unexpected number of frames {}".format(len(frames)))
+        # Nothing above added or removed pictures
+        self.index.touch()
+
+        # Sequence numbers keep names unique, even for several captures
+        # in the same second (or with the clock going backwards).
+        self.seq_lock = threading.Lock()
+        self.seq = 0
+        for name in self.index.view():
+            self.seq = max(self.seq, self.sequence(name))
+
+        for name in RENDITIONS:
+            os.makedirs(os.path.join(self.directory, '.renditions', name), exist_ok=True)
+
+        # Bounded, so that a burst of captures applies backpressure to
+        # the caller instead of piling up full-size frames in memory.
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self.__worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    # Several frames are combined with the layout.Layout template
+    def submit(self, frames, callback = None, blocking = True, template = None):
+        writer = functools.partial(self.writeOut, template=template)
+        return self.__submit(writer, self.genFilename(), frames, callback, blocking)
+
+    # frames is a list of JPEG-encoded frames, which are assembled into
+    # an animated GIF. With boomerang, it plays forwards then backwards.
+    def submitAnimation(self, frames, duration, boomerang = True, callback = None, blocking = True):
+        writer = functools.partial(self.writeAnimation, duration=duration, boomerang=boomerang)
+        return self.__submit(writer, self.genFilename(self.animation_ext), frames, callback, blocking)
+
+    def __submit(self, writer, filename, frames, callback, blocking):
+        future = concurrent.futures.Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        try:
+            self.jobs.put((writer, filename, frames, future), blocking)
+        except queue.Full:
+            return None
+        return future
+
+    # fn(filename) is called from the writer for each new file, once
+    # it's in the index.
+    def addListener(self, fn):
+        self.listeners.append(fn)
+
+    def __notify(self, filename):
+        for fn in self.listeners:
+            fn(filename)
+
+    def flush(self):
+        self.jobs.join()
+
+    def close(self):
+        self.flush()
+        for t in self.workers:
+            self.jobs.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+        self.syncWrites()
+        if self.replicator is not None:
+            self.replicator.close()
+        if self.postprocess is not None:
+            self.postprocess.close()
+        with open(self.marker, 'w') as f:
+            f.write("closed\n")
+
+    # Tidy up after a crash: remove the temporary files writes left
+    # behind, and quarantine files written since the album was opened
+    # which didn't get to the end. Returns how many were quarantined.
+    def recover(self):
+        since = None
+        try:
+            with open(self.marker) as f:
+                if f.read().startswith('open'):
+                    since = os.stat(self.marker).st_mtime
+        except FileNotFoundError:
+            pass
+
+        count = 0
+        if since is not None:
+            quarantine = os.path.join(self.directory, '.quarantine')
+            for root, dirs, files in os.walk(self.directory):
+                if os.path.samefile(root, self.directory) and '.quarantine' in dirs:
+                    dirs.remove('.quarantine')
+                for name in files:
+                    path = os.path.join(root, name)
+                    if name.startswith('.') and name.endswith('.tmp'):
+                        print("Removing partial write {}".format(path))
+                        os.unlink(path)
+                    elif (not os.path.relpath(path, self.directory).startswith('.') and
+                            os.stat(path).st_mtime >= since and not complete(path)):
+                        print("Quarantining incomplete {}".format(path))
+                        dst = os.path.join(quarantine, os.path.relpath(path, self.directory))
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                        os.replace(path, dst)
+                        count += 1
+                        for n in RENDITIONS:
+                            try:
+                                os.unlink(self.renditionPath(path, n))
+                            except FileNotFoundError:
+                                pass
+
+        with open(self.marker, 'w') as f:
+            f.write("open {}\n".format(os.getpid()))
+        return count
+
+    # Write filename via write(f), atomically. sync is whether this file
+    # follows the fsync policy: renditions can always be regenerated.
+    def atomicWrite(self, filename, write, sync = True):
+        tmp = temp_path(filename)
+        with open(tmp, 'wb') as f:
+            write(f)
+            f.flush()
+            if sync and self.fsync == 'file':
+                os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+        if not sync or self.fsync is None:
+            return
+        if self.fsync == 'file':
+            replication.fsync(os.path.dirname(os.path.abspath(filename)), directory=True)
+            return
+
+        with self.sync_lock:
+            self.unsynced.append(filename)
+            due = len(self.unsynced) >= self.fsync_batch
+            if not due and self.sync_timer is None:
+                self.sync_timer = threading.Timer(self.fsync_interval, self.syncWrites)
+                self.sync_timer.daemon = True
+                self.sync_timer.start()
+        if due:
+            self.syncWrites()
+
+    def syncWrites(self):
+        with self.sync_lock:
+            files, self.unsynced = self.unsynced, []
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+        if len(files) == 0:
+            return
+
+        with tracing.span('album.sync'):
+            directories = set()
+            for filename in files:
+                try:
+                    replication.fsync(filename)
+                    directories.add(os.path.dirname(os.path.abspath(filename)))
+                except OSError as e:
+                    print("Failed syncing {}: {}".format(filename, e))
+            for d in directories:
+                replication.fsync(d, directory=True)
+
+    def __worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            writer, filename, frames, future = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(writer(frames, filename))
+                except Exception as e:
+                    print("Failed writing {}: {}".format(filename, e))
+                    future.set_exception(e)
+
+            # Drop the frames now, not when the next job arrives, so
+            # their capture buffers can be reused.
+            job = frames = None
+            self.jobs.task_done()
+
+    # Returns the processed frames, closing the originals. If processing
+    # fails (say a worker was killed, breaking the pool) the originals
+    # are returned instead: better a plain picture than none at all.
+    def __postprocess(self, frames):
+        if self.postprocess is None:
+            return frames
+        try:
+            processed = self.postprocess.map(frames)
+        except Exception as e:
+            print("Post-processing failed, saving unprocessed: {}".format(e))
+            return frames
+        for f in frames:
+            f.close()
+        return processed
+
+    def writeOut(self, frames, filename = None, template = None):
+            if filename is None:
+                filename = self.genFilename()
+
+            frames = self.__postprocess(frames)
+
+            with tracing.span('album.composite'):
+                canvas = composite(frames, template)
+            if canvas is not None:
+                with tracing.span('album.encode'):
+                    data = encoded(canvas)
+                    if data is not None:
+                        self.atomicWrite(filename, lambda f: f.write(data))
+                    else:
+                        self.atomicWrite(filename, lambda f: canvas.save(f, 'jpeg'))
+                with tracing.span('album.renditions'):
+                    self.writeRenditions(filename, canvas)
+                if canvas not in frames:
+                    canvas.close()
+                self.index.add(filename)
+                self.__notify(filename)
 
             for f in frames:
                 f.close()
 
-            if self.backup is not None:
-                shutil.copy2(filename, self.backup)
+            if self.replicator is not None:
+                self.replicator.enqueue(filename)
 
             return filename
 
-    def genFilename(self):
-        return "{}/IMG_{}.{}".format(self.directory,
-                datetime.datetime.utcnow().strftime("%Y-%m-%d_%H%M%SUTC"), self.ext)
+    def writeAnimation(self, frames, filename, duration, boomerang = True):
+        decoded = self.__postprocess([Image.open(io.BytesIO(data)) for data in frames])
+
+        with tracing.span('album.animation'):
+            images = []
+            for img in decoded:
+                images.append(img.convert('P', palette=Image.ADAPTIVE))
+                if len(images) == 1:
+                    self.writeRenditions(filename, img)
+                img.close()
+
+            sequence = images
+            if boomerang:
+                sequence = images + images[-2:0:-1]
+            self.atomicWrite(filename, lambda f: sequence[0].save(f, 'gif', save_all=True,
+                    append_images=sequence[1:], duration=int(duration * 1000), loop=0))
+
+        for img in images:
+            img.close()
+        self.index.add(filename)
+        self.__notify(filename)
+
+        if self.replicator is not None:
+            self.replicator.enqueue(filename)
+
+        return filename
+
+    # Renditions are always JPEG, whatever the original is, and sharded
+    # the same way as the originals.
+    def renditionPath(self, filename, name):
+        root = os.path.abspath(self.directory)
+        base = os.path.splitext(os.path.relpath(os.path.abspath(filename), root))[0]
+        return os.path.join(root, '.renditions', name, base + '.jpg')
+
+    def rendition(self, filename, size):
+        for name, rsize in RENDITIONS.items():
+            if tuple(size) == rsize:
+                path = self.renditionPath(filename, name)
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def writeRenditions(self, filename, img):
+        # Largest first, each one is scaled from the previous
+        for name, size in sorted(RENDITIONS.items(), key=lambda r: r[1], reverse=True):
+            img = img.resize(size, Image.BILINEAR)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            path = self.renditionPath(filename, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.atomicWrite(path, lambda f: img.save(f, 'jpeg', quality=85), sync=False)
+
+    def backfill(self):
+        count = 0
+        for filename in self.list():
+            missing = [n for n in RENDITIONS if not os.path.exists(self.renditionPath(filename, n))]
+            if len(missing) == 0:
+                continue
+            try:
+                img = decode.open_scaled(filename, max(RENDITIONS.values()))
+                self.writeRenditions(filename, img)
+                img.close()
+                count += 1
+            except OSError as e:
+                print("Failed to backfill {}: {}".format(filename, e))
+        return count
+
+    def shardDir(self, when):
+        if self.shard is None:
+            return self.directory
+        directory = os.path.join(self.directory, when.strftime(self.shard))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    # Sequence number from a filename, or 0 for names from before they
+    # had one.
+    @staticmethod
+    def sequence(filename):
+        m = re.search(r'UTC_(\d+)\.\w+$', filename)
+        return int(m.group(1)) if m is not None else 0
+
+    def genFilename(self, ext = None):
+        if ext is None:
+            ext = self.ext
+        with self.seq_lock:
+            self.seq += 1
+            seq = self.seq
+        now = datetime.datetime.utcnow()
+        return "{}/IMG_{}_{:06d}.{}".format(self.shardDir(now), now.strftime("%Y-%m-%d_%H%M%SUTC"),
+                seq, ext)
+
+    # Capture time of an existing file, from its name if it can be,
+    # otherwise when it was last modified.
+    @staticmethod
+    def captureTime(filename):
+        m = re.match(r'IMG_(\d{4}-\d{2}-\d{2}_\d{6})UTC', os.path.basename(filename))
+        if m is not None:
+            return datetime.datetime.strptime(m.group(1), "%Y-%m-%d_%H%M%S")
+        return datetime.datetime.utcfromtimestamp(os.stat(filename).st_mtime)
+
+    # Move files which aren't in the shard they'd be written to now (e.g.
+    # everything, in an album from before sharding) into place, along
+    # with their renditions.
+    def migrate(self):
+        if self.shard is None:
+            return 0
+        count = 0
+        for filename in list(self.list()):
+            directory = self.shardDir(self.captureTime(filename))
+            if os.path.samefile(os.path.dirname(filename), directory):
+                continue
+            target = os.path.join(directory, os.path.basename(filename))
+            for name in RENDITIONS:
+                src = self.renditionPath(filename, name)
+                if os.path.exists(src):
+                    dst = self.renditionPath(target, name)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.replace(src, dst)
+            os.replace(filename, target)
+            count += 1
+        self.index.rebuild()
+        return count
 
     def list(self):
-        return sorted(glob.glob(os.path.join(os.path.abspath(self.directory), '*.{}'.format(self.ext))), reverse=True)
+        return self.index.view()
+
+    def page(self, start, count):
+        return self.index.view().page(start, count)
+
+    # Page through the album, newest first, count files at a time. Each
+    # page is only looked up when it's asked for.
+    def walk(self, count = 64):
+        cursor = None
+        while True:
+            files, cursor = self.index.after(cursor, count)
+            if len(files) > 0:
+                yield files
+            if cursor is None:
+                return
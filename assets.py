@@ -0,0 +1,39 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import os
+from PIL import Image
+
+# On-disk cache of pre-rendered bitmaps, so that startup doesn't have to
+# redo font rendering and padding every time. Keys should include
+# everything the bitmap depends on - use fileKey() for input files, so
+# that editing them invalidates the cache.
+class AssetCache():
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def fileKey(self, filename):
+        return (os.path.abspath(filename), os.path.getmtime(filename))
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.png')
+
+    def image(self, key, build):
+        path = self.path(key)
+        try:
+            img = Image.open(path)
+            img.load()
+            return img
+        except OSError:
+            pass
+
+        img = build()
+        try:
+            img.save(path + '.tmp', 'png')
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print("Failed to cache asset {}: {}".format(path, e))
+        return img
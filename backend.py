@@ -0,0 +1,31 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+# Picks between the real Pi hardware and the stand-ins in sim.py, so that
+# the booth can run on any Linux machine. Select the simulated backend
+# with PHOTOBOOTH_BACKEND=sim, and optionally feed it input from a script
+# with PHOTOBOOTH_SCRIPT=<file> (see sim.Script).
+
+import os
+
+SIMULATED = os.environ.get('PHOTOBOOTH_BACKEND', 'pi') == 'sim'
+
+if SIMULATED:
+    # No display needed, unless one has been asked for explicitly
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+    import sim
+    GPIO = sim.GPIO
+    picamera = sim
+else:
+    import RPi.GPIO as GPIO
+    import picamera
+
+def runScript():
+    path = os.environ.get('PHOTOBOOTH_SCRIPT')
+    if not SIMULATED or path is None:
+        return None
+
+    script = sim.Script(GPIO, path)
+    script.start()
+    return script
@@ -0,0 +1,22 @@
+#!/usr/bin/python3
+
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+# Generate the player renditions for images which were written before
+# Album started producing them.
+#
+# Usage: backfill.py [album directory]
+
+import sys
+
+import album
+
+directory = 'out'
+if len(sys.argv) > 1:
+    directory = sys.argv[1]
+
+a = album.Album(directory)
+count = a.backfill()
+a.close()
+print("Generated renditions for {} images".format(count))
@@ -4,3 +4,9 @@
 SHUTTER_BUTTON = 2
 QUAD_BUTTON = 1
 PLAY_BUTTON = 0
+
+# Reduced copies of each album image, generated when it's written out
+RENDITIONS = {
+    'large': (768, 576),
+    'small': (252, 189),
+}
@@ -3,15 +3,17 @@
 # Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
 # SPDX-License-Identifier: MIT
 
+import queue
 import time
-import threading
-import RPi.GPIO as GPIO
+
+import tracing
+
+from backend import GPIO
 
 class Button:
-    def __init__(self, channel, debounce = 30):
+    def __init__(self, channel, debounce = 30, on_press = None):
         self.channel = channel
-        self._lock = threading.Lock()
-        self._pressed = False
+        self._on_press = on_press
         self._time = time.time()
         self._debounce = debounce / 1000.0
 
@@ -21,28 +23,21 @@ class Button:
     def _callback(self, channel):
         level = GPIO.input(self.channel)
         now = time.time()
+        tracing.mark('button.edge', now)
         debounced = (now - self._time) > self._debounce
         if level == 0 and debounced:
             self._time = now
         elif level == 1 and debounced:
-            self._lock.acquire()
-            self._pressed = True
-            self._lock.release()
-
-    def pressed(self):
-        self._lock.acquire()
-        pressed = self._pressed
-        self._pressed = False
-        self._lock.release()
-        return pressed
+            if self._on_press is not None:
+                self._on_press(now)
 
 class Encoder(Button):
-    def __init__(self, channel_a, channel_b, button):
+    def __init__(self, channel_a, channel_b, button, on_turn = None):
         super(Encoder, self).__init__(button, 80)
 
+        self._on_turn = on_turn
         self.channel_a = channel_a
         self.channel_b = channel_b
-        self._count = 0
         self._laststate = 0
 
         GPIO.setup(self.channel_a, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -54,22 +49,16 @@ class Encoder(Button):
         state = (self._laststate << 2) | ((GPIO.input(self.channel_a) & 1) << 1) | (GPIO.input(self.channel_b) & 1)
         state = state & 0xF
 
-        self._lock.acquire()
+        step = 0
         if (state == 0b0010):
-            self._count = self._count + 1
+            step = 1
         elif (state == 0b0111):
-            self._count = self._count - 1
-        else:
-            pass
-        self._lock.release()
+            step = -1
 
         self._laststate = state
 
-    def count(self):
-        self._lock.acquire()
-        count = self._count
-        self._lock.release()
-        return count
+        if step != 0 and self._on_turn is not None:
+            self._on_turn(step, time.time())
 
 class LED():
     def __init__(self, pin, invert = False):
@@ -99,26 +88,81 @@ class LED():
         GPIO.output(self._pin, self._state)
 
 class Cosmic:
+    # (interval between detents, steps per detent), fastest last
+    ACCELERATION = [
+        (0.05, 1),
+        (0.025, 3),
+        (0, 6),
+    ]
+
     def __init__(self, pin_enc_a, pin_enc_b, pin_enc_button,
                     pin_b1, pin_b2, pin_b3,
                     pin_led1, pin_led2, pin_led3):
+        self.events = queue.Queue()
+        self._last_turn = (0, 0)
         self.buttons = [
-            Button(pin_b1),
-            Button(pin_b2),
-            Button(pin_b3),
+            Button(pin_b1, on_press=lambda t: self.post({'button': 0, 'time': t})),
+            Button(pin_b2, on_press=lambda t: self.post({'button': 1, 'time': t})),
+            Button(pin_b3, on_press=lambda t: self.post({'button': 2, 'time': t})),
         ]
         self.leds = [
             LED(pin_led1),
             LED(pin_led2),
             LED(pin_led3),
         ]
-        self.enc = Encoder(pin_enc_a, pin_enc_b, pin_enc_button)
-
-    def pressed(self, button):
-        return self.buttons[button].pressed()
-
-    def count(self):
-        return self.enc.count()
+        self.enc = Encoder(pin_enc_a, pin_enc_b, pin_enc_button,
+                on_turn=lambda step, t: self.post({'encoder': step, 'time': t}))
+
+    def post(self, event):
+        self.events.put(event)
+
+    # Wake up wait() without any input, e.g. when background work has
+    # finished and needs drawing.
+    def wake(self):
+        self.post(None)
+
+    # Block until there's at least one event, or timeout seconds have
+    # passed (None waits forever), then return everything queued.
+    def wait(self, timeout = None):
+        events = []
+        try:
+            if timeout is None or timeout > 0:
+                events.append(self.events.get(timeout=timeout))
+            while True:
+                events.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return self.coalesce([e for e in events if e is not None])
+
+    # Merge all the encoder events into one, at the position of the first.
+    # 'detents' is the raw count, 'encoder' is accelerated based on how
+    # quickly the knob is being turned.
+    def coalesce(self, events):
+        merged = None
+        result = []
+        for event in events:
+            if 'encoder' not in event:
+                result.append(event)
+                continue
+
+            step = event['encoder']
+            last_step, last_time = self._last_turn
+            multiplier = 1
+            if step == last_step:
+                for interval, multiplier in Cosmic.ACCELERATION:
+                    if event['time'] - last_time >= interval:
+                        break
+            self._last_turn = (step, event['time'])
+
+            if merged is None:
+                merged = { 'encoder': 0, 'detents': 0, 'time': event['time'] }
+                result.append(merged)
+            merged['encoder'] += step * multiplier
+            merged['detents'] += step
+
+        if merged is not None and merged['detents'] == 0:
+            result.remove(merged)
+        return result
 
     def led(self, led):
         return self.leds[led]
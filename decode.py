@@ -0,0 +1,38 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+import pygame
+from PIL import Image
+
+# Ask the JPEG decoder to scale by 1/2, 1/4 or 1/8 during the IDCT, picking
+# the smallest scale which still covers size. Does nothing for other
+# formats, or once the image has already been loaded.
+def reduce(img, size):
+    if img.format == 'JPEG':
+        mode = img.mode
+        if mode not in ('RGB', 'L'):
+            mode = 'RGB'
+        img.draft(mode, tuple(size))
+    return img
+
+def open_scaled(filename, size):
+    return reduce(Image.open(filename), size)
+
+def fit(src, size):
+    scale = min(size[0] / src[0], size[1] / src[1])
+    return (int(src[0] * scale), int(src[1] * scale))
+
+def load(filename, size, keep_aspect = False):
+    img = open_scaled(filename, size)
+    target = tuple(size)
+    if keep_aspect:
+        target = fit(img.size, size)
+    if img.size != target:
+        img = img.resize(target, Image.BILINEAR)
+    return img
+
+def load_surface(filename, size):
+    img = load(filename, size)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    return pygame.image.fromstring(img.tobytes(), img.size, img.mode)
@@ -0,0 +1,86 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+from PIL import Image
+
+# Layouts are a grid of cells, each cell being 'cell' times the size of a
+# captured frame. Slots are (column, row, span), in order of capture.
+class Layout():
+    def __init__(self, cell, slots, margin = 0, background = (255, 255, 255),
+            footer = 0, logo = None):
+        self.cell = cell
+        self.slots = slots
+        self.margin = margin
+        self.background = background
+        self.footer = footer
+        self.logo = logo
+        self.cols = max(s[0] + s[2] for s in slots)
+        self.rows = max(s[1] + s[2] for s in slots)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def cellSize(self, frame_size):
+        return (int(frame_size[0] * self.cell), int(frame_size[1] * self.cell))
+
+    def canvasSize(self, frame_size):
+        cell = self.cellSize(frame_size)
+        return (
+            self.cols * cell[0] + (self.cols + 1) * self.margin,
+            self.rows * cell[1] + (self.rows + 1) * self.margin + self.footer,
+        )
+
+    def slotRect(self, idx, frame_size):
+        cell = self.cellSize(frame_size)
+        col, row, span = self.slots[idx]
+        return (
+            self.margin + col * (cell[0] + self.margin),
+            self.margin + row * (cell[1] + self.margin),
+            span * cell[0] + (span - 1) * self.margin,
+            span * cell[1] + (span - 1) * self.margin,
+        )
+
+TEMPLATES = {
+    '2x2': Layout(1, [(0, 0, 1), (1, 0, 1), (0, 1, 1), (1, 1, 1)]),
+    'strip': Layout(0.5, [(0, 0, 1), (0, 1, 1), (0, 2, 1), (0, 3, 1)], margin=24, footer=120),
+    '1+3': Layout(1 / 3, [(0, 0, 3), (3, 0, 1), (3, 1, 1), (3, 2, 1)], margin=16),
+}
+
+# A layout being filled in. The canvas is allocated up-front, and each
+# frame is pasted in as soon as it's added, so that once the last frame
+# arrives the only thing left to do is encode it.
+class Collage():
+    def __init__(self, layout, frame_size):
+        self.layout = layout
+        self.frame_size = frame_size
+        self.canvas = Image.new('RGB', layout.canvasSize(frame_size), layout.background)
+        self.count = 0
+
+        if layout.logo is not None:
+            logo = Image.open(layout.logo)
+            area = (self.canvas.size[0], layout.footer)
+            logo.thumbnail(area)
+            pos = (int((area[0] - logo.size[0]) / 2),
+                   self.canvas.size[1] - layout.footer + int((area[1] - logo.size[1]) / 2))
+            if logo.mode == 'RGBA':
+                self.canvas.paste(logo, pos, logo)
+            else:
+                self.canvas.paste(logo, pos)
+            logo.close()
+
+    def full(self):
+        return self.count >= len(self.layout)
+
+    def add(self, frame):
+        if self.full():
+            print("Collage already full")
+            return
+
+        x, y, w, h = self.layout.slotRect(self.count, self.frame_size)
+        if frame.size != (w, h):
+            frame = frame.resize((w, h), Image.BILINEAR)
+        self.canvas.paste(frame, (x, y))
+        self.count += 1
+
+    def result(self):
+        return self.canvas
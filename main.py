@@ -4,16 +4,20 @@
 # SPDX-License-Identifier: MIT
 
 import pygame
-import RPi.GPIO as GPIO
 import time
 
 import activity
 import album
+import assets
+import backend
 import cosmic
 import player
+import postprocess
 import preview
+import slideshow
+import tracing
 
-from consts import SHUTTER_BUTTON, QUAD_BUTTON, PLAY_BUTTON
+from backend import GPIO
 
 pin_enc_a = 23
 pin_enc_b = 24
@@ -29,14 +33,6 @@ pin_led3 = 16
 
 pin_flash = 12
 
-def sign(val):
-    if val > 0:
-        return 1
-    elif val < 0:
-        return -1
-    else:
-        return 0
-
 # (3280, 2464): v2 module max resolution
 #capture_resolution = (3280, 2464)
 # 1640x1232 is smallest full frame mode
@@ -47,55 +43,82 @@ preview_resolution = (768, 576)
 
 window_size = (1024, 600)
 
-GPIO.setmode(GPIO.BCM)
+# Seconds without input before the slideshow starts, or None for never
+attract_timeout = 120
+
+# Applied to every frame before it's saved, e.g.:
+#   postprocess.Grade(contrast=1.1, warmth=8),
+#   postprocess.Watermark('logo.png', opacity=0.8),
+#   postprocess.Border(16),
+postprocess_steps = []
+
+startup = time.time()
+tracing.configure('trace')
+
+# First, before there are any other threads to get in the way of forking
+with tracing.span('startup.postprocess'):
+    pipeline = None
+    if len(postprocess_steps) > 0:
+        pipeline = postprocess.Pipeline(postprocess_steps)
 
-flash = cosmic.LED(pin_flash, True)
+with tracing.span('startup.gpio'):
+    GPIO.setmode(GPIO.BCM)
 
-panel = cosmic.Cosmic(pin_enc_a, pin_enc_b, pin_enc_button,
-            pin_b1, pin_b2, pin_b3,
-            pin_led1, pin_led2, pin_led3)
+    flash = cosmic.LED(pin_flash, True)
 
-pygame.init()
-screen = pygame.display.set_mode((1024, 600))
-pygame.mouse.set_visible(False)
-screen.fill((0, 0, 0))
-pygame.display.flip()
+    panel = cosmic.Cosmic(pin_enc_a, pin_enc_b, pin_enc_button,
+                pin_b1, pin_b2, pin_b3,
+                pin_led1, pin_led2, pin_led3)
 
-album = album.Album('out')
+backend.runScript()
+
+with tracing.span('startup.display'):
+    pygame.init()
+    screen = pygame.display.set_mode((1024, 600))
+    pygame.mouse.set_visible(False)
+    screen.fill((0, 0, 0))
+    pygame.display.flip()
+
+with tracing.span('startup.album'):
+    album = album.Album('out', postprocess=pipeline)
 
 am = activity.ActivityManager()
-am.register('preview',
-        preview.PreviewActivity(cosmic=panel, screen=screen, screen_resolution=window_size,
-                resolution=capture_resolution, preview_resolution=preview_resolution, album=album, flash=flash)
+with tracing.span('startup.preview'):
+    am.register('preview',
+            preview.PreviewActivity(cosmic=panel, screen=screen, screen_resolution=window_size,
+                    resolution=capture_resolution, preview_resolution=preview_resolution, album=album, flash=flash,
+                    assets=assets.AssetCache('.cache'), encode_single=True, attract_timeout=attract_timeout)
+    )
+am.registerAsync('player',
+        lambda: player.PlayerActivity(cosmic=panel, screen=screen, screen_resolution=window_size,
+                album=album)
 )
-am.register('player',
-        player.PlayerActivity(cosmic=panel, screen=screen, screen_resolution=window_size,
+am.registerAsync('slideshow',
+        lambda: slideshow.SlideshowActivity(cosmic=panel, screen=screen, screen_resolution=window_size,
                 album=album)
 )
-am.start('preview')
+with tracing.span('startup.start'):
+    am.start('preview')
+tracing.record('startup', startup)
+
+print("Startup took {:.3f}s:".format(time.time() - startup))
+for phase, duration in tracing.last('startup.'):
+    print("  {:<20} {:.3f}s".format(phase, duration))
 
 try:
-    encoder_pos = panel.count()
     while True:
-        time.sleep (1.0/24)
-
-        events = []
-        count = panel.count()
-        if panel.pressed(PLAY_BUTTON):
-            events.append({'button': PLAY_BUTTON})
-        if panel.pressed(QUAD_BUTTON):
-            events.append({'button': QUAD_BUTTON})
-        if panel.pressed(SHUTTER_BUTTON):
-            events.append({'button': SHUTTER_BUTTON})
-        if count != encoder_pos:
-            val = sign(count - encoder_pos)
-            encoder_pos += val
-            events.append({'encoder': val})
+        timeout = None
+        deadline = am.nextDeadline()
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
 
+        events = panel.wait(timeout)
         am.tick(events)
 
 except KeyboardInterrupt:
     pass
 
 am.exit()
+album.close()
+tracing.export()
 GPIO.cleanup()
@@ -0,0 +1,22 @@
+#!/usr/bin/python3
+
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+# Move the pictures in an album written before it was sharded (or with a
+# different sharding) into per-day shard directories.
+#
+# Usage: migrate.py [album directory]
+
+import sys
+
+import album
+
+directory = 'out'
+if len(sys.argv) > 1:
+    directory = sys.argv[1]
+
+a = album.Album(directory)
+count = a.migrate()
+a.close()
+print("Moved {} images into shards".format(count))
@@ -1,78 +1,306 @@
 # Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
 # SPDX-License-Identifier: MIT
 
+import collections
+import concurrent.futures
+import functools
 import pygame
 
 import activity
+import decode
+import render
 import threading
+import time
 
-from consts import SHUTTER_BUTTON, QUAD_BUTTON, PLAY_BUTTON
+from consts import SHUTTER_BUTTON, QUAD_BUTTON, PLAY_BUTTON, RENDITIONS
 
 def add_wrap(val, add, n):
     if n == 0:
         return val
     return (val + add) % n
 
-class ImageCache(dict):
-    def __init__(self, nslots, files, large_res, small_res, start_idx = 0):
-        self.sem = threading.Semaphore()
+def surface_bytes(surface):
+    if surface is None:
+        return 0
+    return surface.get_pitch() * surface.get_height()
+
+# Keeps the (large, small) surfaces for a window of indices around the
+# current one. The window is as big as fits in budget bytes, and the
+# surfaces are stored in the display's pixel format, so blitting them
+# doesn't need a conversion.
+# Entries are keyed by filename, so they survive the file list being
+# replaced with one where new captures have shifted the indices.
+class ImageCache():
+    def __init__(self, budget, album, files, large_res, small_res, start_idx = 0, workers = 2,
+            on_load = None):
+        # Re-entrant: a load can complete, and run its callback, while
+        # prefetch() is still queueing the rest of the window.
+        self.lock = threading.RLock()
         self.items = {}
+        self.inflight = {}
+        self.window = set()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.album = album
         self.files = files
-        self.nslots = nslots
         self.large_res = large_res
         self.small_res = small_res
+        self.on_load = on_load
+
+        self.display = pygame.display.get_surface()
+        bpp = self.display.get_bytesize() if self.display is not None else 4
+        entry = (large_res[0] * large_res[1] + small_res[0] * small_res[1]) * bpp
+        self.budget = budget
+        self.nslots = max(3, budget // entry)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident = 0
+
+        self.prefetch(start_idx)
+
+    def setFiles(self, files):
+        with self.lock:
+            self.files = files
+
+    # Whatever is loaded for idx right now, without waiting. Either None,
+    # (None, small) while the large image is still loading, or both.
+    def peek(self, idx):
+        with self.lock:
+            item = self.items.get(self.files[idx])
+            if item is not None and item[0] is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return item
+
+    def load(self, filename):
+        imgs = [None, None]
 
-        self.trigger_refill(start_idx)
+        # Small first, so there's something to show while the large one loads
+        for i, res in ((1, self.small_res), (0, self.large_res)):
+            rendition = self.album.rendition(filename, res)
+            if rendition is not None:
+                imgs[i] = self.__convert(pygame.image.load(rendition))
+                if i == 1:
+                    self.__partial(filename, imgs[1])
 
-    def get(self, idx):
-        if idx not in self.items:
-            self.load(idx)
-            self.trigger_refill(idx)
-        imgs = self.items[idx]
-        return imgs
+        if None in imgs:
+            # Only decode the original if a rendition is missing, and
+            # then only at the size of the largest view.
+            img = decode.load_surface(filename, self.large_res)
+            for i, res in enumerate((self.large_res, self.small_res)):
+                if imgs[i] is not None:
+                    continue
+                if img.get_size() == tuple(res):
+                    imgs[i] = self.__convert(img)
+                else:
+                    imgs[i] = self.__convert(pygame.transform.scale(img, res))
+        return tuple(imgs)
 
-    def trigger_refill(self, idx):
-        if self.sem.acquire(blocking=False):
-            self.thread = threading.Thread(target=self.__refill, args=[idx]).start()
-        return
+    def __convert(self, surface):
+        if self.display is None:
+            return surface
+        return surface.convert(self.display)
 
-    def load(self, idx):
-        if idx in self.items:
+    # Must hold the lock
+    def __store(self, name, item):
+        self.__evict(name, count=False)
+        self.items[name] = item
+        self.resident += sum(surface_bytes(s) for s in item)
+
+    def __evict(self, name, count = True):
+        item = self.items.pop(name, None)
+        if item is None:
             return
+        self.resident -= sum(surface_bytes(s) for s in item)
+        if count:
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'resident': self.resident,
+                'budget': self.budget,
+                'slots': self.nslots,
+            }
+
+    def __partial(self, name, small):
+        with self.lock:
+            if name not in self.window or name in self.items:
+                return
+            self.__store(name, (None, small))
+
+        if self.on_load is not None:
+            self.on_load(name)
+
+    # Window of indices to keep warm around idx, nearest first, with
+    # most of the slots in the direction we're moving.
+    def __window(self, idx, direction):
+        if direction == 0:
+            ahead = (self.nslots - 1) // 2
+            step = 1
+        else:
+            ahead = (self.nslots * 3) // 4
+            step = direction
+        behind = self.nslots - 1 - ahead
+
+        order = [idx]
+        for i in range(1, ahead + 1):
+            order.append(add_wrap(idx, i * step, len(self.files)))
+            if i <= behind:
+                order.append(add_wrap(idx, -i * step, len(self.files)))
+
+        return list(dict.fromkeys(order))
+
+    def prefetch(self, idx, direction = 0):
+        with self.lock:
+            order = [self.files[i] for i in self.__window(idx, direction)]
+            self.window = set(order)
+            for k in list(self.items.keys()):
+                if k not in self.window:
+                    self.__evict(k)
+
+            for k, future in list(self.inflight.items()):
+                if k not in self.window and future.cancel():
+                    del self.inflight[k]
+
+            for k in order:
+                if k in self.items or k in self.inflight:
+                    continue
+                future = self.pool.submit(self.load, k)
+                self.inflight[k] = future
+                future.add_done_callback(functools.partial(self.__complete, k))
+
+    def __complete(self, name, future):
+        if future.cancelled():
+            return
+
+        stored = False
+        with self.lock:
+            if self.inflight.get(name) is future:
+                del self.inflight[name]
+                if name in self.window and future.exception() is None:
+                    self.__store(name, future.result())
+                    stored = True
+
+        if stored and self.on_load is not None:
+            self.on_load(name)
+
+    def close(self):
+        with self.lock:
+            for future in self.inflight.values():
+                future.cancel()
+            self.inflight = {}
+        self.pool.shutdown(wait=False)
+
+
+# Pages of thumbnails for the grid view. Each page is rendered into a
+# single screen-sized atlas surface, so drawing a page is one blit.
+# Pages are built in the background, with the neighbours of the current
+# page built ahead of time.
+class GridAtlas():
+    def __init__(self, album, files, size, cols, rows, small_res, on_load = None, npages = 5):
+        # Re-entrant: a build which has already finished runs its
+        # callback straight away, while prefetch() still holds the lock.
+        self.lock = threading.RLock()
+        self.pages = collections.OrderedDict()
+        self.inflight = {}
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.album = album
+        self.files = files
+        self.size = size
+        self.cols = cols
+        self.rows = rows
+        self.small_res = small_res
+        self.on_load = on_load
+        self.npages = npages
+
+        self.cell = (size[0] // cols, size[1] // rows)
+        # Largest 4:3 thumbnail that leaves room for a highlight around it
+        scale = min((self.cell[0] - 16) / 4, (self.cell[1] - 16) / 3)
+        self.thumb = (int(scale * 4), int(scale * 3))
+
+    def perPage(self):
+        return self.cols * self.rows
 
-        img = pygame.image.load(self.files[idx])
-        imgs = (
-                pygame.transform.scale(img, self.large_res),
-                pygame.transform.scale(img, self.small_res)
-        )
-        self.items[idx] = imgs
+    def numPages(self):
+        return (len(self.files) + self.perPage() - 1) // self.perPage()
 
-    def evict(self, idx):
-        del self.items[idx]
+    def cellRect(self, idx):
+        i = idx % self.perPage()
+        return pygame.Rect(((i % self.cols) * self.cell[0], (i // self.cols) * self.cell[1]), self.cell)
 
-    def __refill(self, idx):
-        new_range = set([add_wrap(idx, i - ((self.nslots) // 2), len(self.files)) for i in range(self.nslots)])
-        old_range = self.items.keys()
-        to_load = new_range - old_range
-        to_evict = old_range - new_range
+    def thumbRect(self, idx):
+        rect = pygame.Rect((0, 0), self.thumb)
+        rect.center = self.cellRect(idx).center
+        return rect
 
-        for k in to_evict:
-            self.evict(k)
+    def page(self, n):
+        with self.lock:
+            return self.pages.get(n)
 
-        for k in to_load:
-            self.load(k)
+    def build(self, n):
+        atlas = pygame.Surface(self.size)
+        atlas.fill((255, 255, 255))
+        start = n * self.perPage()
+        for idx in range(start, min(start + self.perPage(), len(self.files))):
+            filename = self.files[idx]
+            rendition = self.album.rendition(filename, self.small_res)
+            if rendition is not None:
+                img = pygame.image.load(rendition)
+            else:
+                img = decode.load_surface(filename, self.thumb)
+            atlas.blit(pygame.transform.smoothscale(img, self.thumb), self.thumbRect(idx))
+        return atlas
 
-        self.sem.release()
+    def prefetch(self, n):
+        pages = self.numPages()
+        wanted = [n, add_wrap(n, 1, pages), add_wrap(n, -1, pages)]
+        with self.lock:
+            for k in wanted:
+                if k in self.pages:
+                    self.pages.move_to_end(k)
+                elif k not in self.inflight:
+                    future = self.pool.submit(self.build, k)
+                    self.inflight[k] = future
+                    future.add_done_callback(functools.partial(self.__complete, k))
 
+            while len(self.pages) > self.npages:
+                self.pages.popitem(last=False)
+
+    def __complete(self, n, future):
+        if future.cancelled():
+            return
+
+        with self.lock:
+            del self.inflight[n]
+            if future.exception() is not None:
+                print("Failed building page {}: {}".format(n, future.exception()))
+                return
+            self.pages[n] = future.result()
+
+        if self.on_load is not None:
+            self.on_load(n)
+
+    def close(self):
+        with self.lock:
+            for future in self.inflight.values():
+                future.cancel()
+        self.pool.shutdown(wait=False)
 
 class PlayerActivity(activity.Activity):
-    def __init__(self, cosmic, screen, screen_resolution, album):
+    def __init__(self, cosmic, screen, screen_resolution, album, cache_budget = 32 * 1024 * 1024):
         self.cosmic = cosmic
+        self.cache_budget = cache_budget
         self.screen = screen
         self.album = album
         self.screen_resolution = screen_resolution
-        self.main_resolution = (768, 576)
-        self.small_resolution = (252, 63 * 3)
+        self.main_resolution = RENDITIONS['large']
+        self.small_resolution = RENDITIONS['small']
         self.colors = [
             [255, 100, 0],
             [100, 250, 0],
@@ -85,8 +313,16 @@ class PlayerActivity(activity.Activity):
         ]
         self.files = self.album.list()
         self.cache = None
+        # Set from the album's writer when there's a new capture
+        self.stale = True
+        self.active = False
         self.idx = 0
+        self.direction = 0
         self.dirty = False
+        self.renderer = render.Renderer(self.screen)
+        self.grid = False
+        self.atlas = None
+        self.cursor = None
 
         top_border = (self.screen_resolution[1] - self.main_resolution[1]) / 2
         self.rects = [
@@ -101,53 +337,180 @@ class PlayerActivity(activity.Activity):
                 self.small_resolution),
         ]
 
+        self.album.addListener(self.onAlbumChanged)
+
+    def drawBackground(self):
+        self.renderer.invalidate()
+        self.renderer.fill(None, None, (255, 255, 255))
+        self.renderer.fill(None, None, (255, 255, 0), self.rects[2].inflate(8, 8))
+
+    # Called from the album's writer
+    def onAlbumChanged(self, filename):
+        self.stale = True
+        self.cosmic.wake()
+
+    # Pick up new captures. The cache keeps what it has already loaded,
+    # but the grid pages have all shifted.
+    def refresh(self):
+        self.stale = False
+        self.files = self.album.list()
+        self.idx = 0
+        if self.atlas is not None:
+            self.atlas.close()
+            self.atlas = None
+        if len(self.files) == 0:
+            return
+        if self.cache is None:
+            self.cache = ImageCache(self.cache_budget, self.album, self.files, self.main_resolution,
+                    self.small_resolution, on_load=self.onLoaded)
+        else:
+            self.cache.setFiles(self.files)
+            self.cache.prefetch(self.idx)
 
+    # Warm the cache with the newest pictures while something else is
+    # on screen, so that the gallery is ready as soon as it's opened.
+    def onIdle(self):
+        if self.stale:
+            self.refresh()
 
     def onResume(self):
+        self.active = True
         self.cosmic.led(PLAY_BUTTON).on()
-        self.screen.fill((255, 255, 255))
-        self.screen.fill((255, 255, 0), self.rects[2].inflate(8, 8))
-        self.files = self.album.list()
-        if len(self.files) > 0:
-            self.cache = ImageCache(12, self.files, self.main_resolution, self.small_resolution)
+        # Lit for the grid view, which isn't where we start
+        self.cosmic.led(QUAD_BUTTON).set(False)
+        self.drawBackground()
+        self.grid = False
+        if self.stale:
+            self.refresh()
+        elif self.cache is not None:
             self.idx = 0
-            self.cache.get(self.idx)
+            self.cache.prefetch(self.idx)
+        if len(self.files) > 0:
             self.dirty = True
         else:
-            self.screen.fill((180, 180, 180), self.rects[0])
-            self.screen.fill((180, 180, 180), self.rects[1])
-            self.screen.fill((180, 180, 180), self.rects[2])
-            self.screen.fill((180, 180, 180), self.rects[3])
-        pygame.display.update()
+            for i in range(len(self.rects)):
+                self.renderer.fill(i, None, (180, 180, 180), self.rects[i])
+            self.renderer.flush()
 
     def onPause(self):
+        self.active = False
         self.cosmic.led(PLAY_BUTTON).off()
+        self.cosmic.led(QUAD_BUTTON).off()
+
+    def onExit(self):
+        if self.cache is not None:
+            print("Image cache: {}".format(self.cache.stats()))
+            self.cache.close()
+        if self.atlas is not None:
+            self.atlas.close()
+
+    def setGrid(self, grid):
+        self.grid = grid
+        self.cosmic.led(QUAD_BUTTON).set(self.grid)
+        self.renderer.invalidate()
+        if self.grid:
+            if self.atlas is None:
+                self.atlas = GridAtlas(self.album, self.files, self.screen_resolution, 4, 3,
+                        self.small_resolution, on_load=self.onPageLoaded)
+            self.atlas.prefetch(self.idx // self.atlas.perPage())
+            self.cursor = None
+        else:
+            self.drawBackground()
+            self.cache.prefetch(self.idx)
+        self.dirty = True
+
+    # Called from the atlas' worker
+    def onPageLoaded(self, page):
+        if self.grid and page == self.idx // self.atlas.perPage():
+            self.dirty = True
+            self.cosmic.wake()
+
+    def drawGrid(self):
+        page = self.idx // self.atlas.perPage()
+        atlas = self.atlas.page(page)
+        key = (page, atlas is not None)
+        if not self.renderer.shows('grid', key):
+            if atlas is None:
+                self.renderer.fill('grid', key, (180, 180, 180))
+            else:
+                self.renderer.blit('grid', key, atlas, (0, 0))
+            self.cursor = None
+
+        # Move the highlight, restoring the cell it was on from the atlas
+        if self.cursor != self.idx:
+            if self.cursor is not None and atlas is not None:
+                rect = self.atlas.cellRect(self.cursor)
+                self.screen.blit(atlas, rect, rect)
+                self.renderer.damaged(rect)
+            rect = self.atlas.thumbRect(self.idx).inflate(12, 12)
+            pygame.draw.rect(self.screen, (255, 255, 0), rect, 6)
+            self.renderer.damaged(rect)
+            self.cursor = self.idx
+
+        self.renderer.flush()
+        self.dirty = False
+
+    # Called from the cache's workers, also while paused
+    def onLoaded(self, filename):
+        if not self.active or filename not in self.visible():
+            return
+        self.dirty = True
+        self.cosmic.wake()
+
+    def visible(self):
+        files = self.files
+        return set(files[add_wrap(self.idx, i, len(files))] for i in (-1, 0, 1))
+
+    def nextDeadline(self):
+        if self.dirty:
+            return time.time()
+        return None
 
     def onDraw(self):
         if not self.dirty or len(self.files) == 0:
             return
 
-        # Main picture in main and middle slot
-        idx = self.idx
-        imgs = self.cache.get(idx)
-        self.screen.blit(imgs[0], self.rects[0])
-        self.screen.blit(imgs[1], self.rects[2])
-
-        idx = add_wrap(self.idx, -1, len(self.files))
-        imgs = self.cache.get(idx)
-        self.screen.blit(imgs[1], self.rects[1])
+        if self.grid:
+            self.drawGrid()
+            return
 
-        idx = add_wrap(self.idx, 1, len(self.files))
-        imgs = self.cache.get(idx)
-        self.screen.blit(imgs[1], self.rects[3])
+        # Main picture in main and middle slot, (index, image) for each
+        slots = [
+            (self.idx, 0),
+            (add_wrap(self.idx, -1, len(self.files)), 1),
+            (self.idx, 1),
+            (add_wrap(self.idx, 1, len(self.files)), 1),
+        ]
+        for i, (idx, img) in enumerate(slots):
+            # Never wait for a load: show the best of what's there now,
+            # and redraw when something better arrives.
+            imgs = self.cache.peek(idx)
+            if imgs is None:
+                key = (self.files[idx], None)
+                self.renderer.fill(i, key, self.colors[idx % len(self.colors)], self.rects[i])
+            elif imgs[img] is None:
+                key = (self.files[idx], 'low')
+                if not self.renderer.shows(i, key):
+                    self.renderer.blit(i, key, pygame.transform.scale(imgs[1], self.rects[i].size),
+                            self.rects[i])
+            else:
+                key = (self.files[idx], img)
+                self.renderer.blit(i, key, imgs[img], self.rects[i])
 
-        pygame.display.flip()
+        self.renderer.flush()
         self.dirty = False
 
     def onInputReceived(self, events):
         for event in events:
             if 'button' in event and (event['button'] == PLAY_BUTTON or event['button'] == SHUTTER_BUTTON):
                 return 'preview'
-            elif 'encoder' in event:
+            elif 'button' in event and event['button'] == QUAD_BUTTON and len(self.files) > 0:
+                self.setGrid(not self.grid)
+            elif 'encoder' in event and len(self.files) > 0 and event['encoder'] != 0:
                 self.idx = add_wrap(self.idx, event['encoder'], len(self.files))
+                self.direction = 1 if event['encoder'] > 0 else -1
+                if self.grid:
+                    self.atlas.prefetch(self.idx // self.atlas.perPage())
+                else:
+                    self.cache.prefetch(self.idx, self.direction)
                 self.dirty = True
@@ -0,0 +1,196 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+import concurrent.futures
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image, ImageEnhance
+
+import decode
+import tracing
+
+# Steps are run in the worker processes, so they need to pickle. Each
+# one takes an image and returns the processed one, and can tell in
+# advance what size that will be.
+class Step():
+    def size(self, size):
+        return size
+
+    def apply(self, img):
+        return img
+
+class Resize(Step):
+    def __init__(self, size):
+        self.max_size = tuple(size)
+
+    def size(self, size):
+        return decode.fit(size, self.max_size)
+
+    def apply(self, img):
+        return img.resize(self.size(img.size), Image.BICUBIC)
+
+class Border(Step):
+    def __init__(self, width, color = (255, 255, 255)):
+        self.width = width
+        self.color = color
+
+    def size(self, size):
+        return (size[0] + self.width * 2, size[1] + self.width * 2)
+
+    def apply(self, img):
+        canvas = Image.new(img.mode, self.size(img.size), self.color)
+        canvas.paste(img, (self.width, self.width))
+        return canvas
+
+class Grade(Step):
+    def __init__(self, brightness = 1.0, contrast = 1.0, saturation = 1.0, warmth = 0):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.warmth = warmth
+
+    def apply(self, img):
+        if self.brightness != 1.0:
+            img = ImageEnhance.Brightness(img).enhance(self.brightness)
+        if self.contrast != 1.0:
+            img = ImageEnhance.Contrast(img).enhance(self.contrast)
+        if self.saturation != 1.0:
+            img = ImageEnhance.Color(img).enhance(self.saturation)
+        if self.warmth != 0:
+            # Push red up and blue down (or the other way for negative)
+            lut = [min(255, max(0, v + self.warmth)) for v in range(256)] + \
+                    list(range(256)) + \
+                    [min(255, max(0, v - self.warmth)) for v in range(256)]
+            img = img.point(lut)
+        return img
+
+# Logo in one corner, scaled to a fraction of the frame width
+class Watermark(Step):
+    logos = {}
+
+    def __init__(self, filename, scale = 0.2, opacity = 1.0, corner = 'br', margin = 0.02):
+        self.filename = filename
+        self.scale = scale
+        self.opacity = opacity
+        self.corner = corner
+        self.margin = margin
+
+    def logo(self, width):
+        key = (self.filename, width)
+        if key not in Watermark.logos:
+            logo = Image.open(self.filename).convert('RGBA')
+            height = logo.size[1] * width // logo.size[0]
+            logo = logo.resize((width, height), Image.BICUBIC)
+            if self.opacity < 1.0:
+                alpha = logo.getchannel('A').point(lambda a: int(a * self.opacity))
+                logo.putalpha(alpha)
+            Watermark.logos[key] = logo
+        return Watermark.logos[key]
+
+    def apply(self, img):
+        logo = self.logo(int(img.size[0] * self.scale))
+        margin = int(img.size[0] * self.margin)
+        x = margin if 'l' in self.corner else img.size[0] - logo.size[0] - margin
+        y = margin if 't' in self.corner else img.size[1] - logo.size[1] - margin
+        img = img.copy()
+        img.paste(logo, (x, y), logo)
+        return img
+
+# Runs in the worker: the frame is read from one shared memory block,
+# and the result written into another which the caller sized already.
+def _process(steps, src, size, dst, out_size):
+    shm_in = shared_memory.SharedMemory(src)
+    shm_out = shared_memory.SharedMemory(dst)
+    try:
+        img = Image.frombuffer('RGB', size, shm_in.buf, 'raw', 'RGB', 0, 1)
+        for step in steps:
+            img = step.apply(img)
+        if img.size != out_size:
+            raise ValueError("Expected {}, got {}".format(out_size, img.size))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        data = img.tobytes()
+        shm_out.buf[:len(data)] = data
+        # The image may still be a view of shm_in
+        img = data = None
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+# Applies a list of steps to frames, one frame per process, so that the
+# four frames of a quad are processed on separate cores.
+class Pipeline():
+    def __init__(self, steps, workers = 4):
+        self.steps = list(steps)
+        # Forked, rather than spawned, so the workers don't re-run main.py.
+        # Forking a process with threads running can deadlock, so this
+        # needs creating before any threads are started. The first job
+        # makes the pool fork all of its workers straight away.
+        # The workers need to share our resource tracker, or they each
+        # start their own, which never hears about the segments being
+        # unlinked and complains about them all at exit.
+        resource_tracker.ensure_running()
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                mp_context=multiprocessing.get_context('fork'))
+        self.pool.submit(int).result()
+
+    def size(self, size):
+        for step in self.steps:
+            size = step.size(size)
+        return size
+
+    def __submit(self, frame):
+        if frame.mode != 'RGB':
+            frame = frame.convert('RGB')
+        data = frame.tobytes()
+        out_size = self.size(frame.size)
+
+        src = shared_memory.SharedMemory(create=True, size=len(data))
+        dst = shared_memory.SharedMemory(create=True, size=out_size[0] * out_size[1] * 3)
+        src.buf[:len(data)] = data
+        data = None
+
+        try:
+            future = self.pool.submit(_process, self.steps, src.name, frame.size, dst.name, out_size)
+        except Exception:
+            # e.g. BrokenProcessPool, after a worker was killed
+            for shm in (src, dst):
+                shm.close()
+                shm.unlink()
+            raise
+        return (future, src, dst, out_size)
+
+    def __collect(self, job):
+        future, src, dst, out_size = job
+        try:
+            future.result()
+            return Image.frombytes('RGB', out_size, bytes(dst.buf[:out_size[0] * out_size[1] * 3]))
+        finally:
+            for shm in (src, dst):
+                shm.close()
+                shm.unlink()
+
+    # Returns new images, the originals are left for the caller to close
+    def map(self, frames):
+        with tracing.span('postprocess'):
+            jobs = []
+            results = []
+            error = None
+            for f in frames:
+                try:
+                    jobs.append(self.__submit(f))
+                except Exception as e:
+                    error = e
+                    break
+            # Collect everything, so all the shared memory is released
+            for job in jobs:
+                try:
+                    results.append(self.__collect(job))
+                except Exception as e:
+                    error = e
+            if error is not None:
+                raise error
+            return results
+
+    def close(self):
+        self.pool.shutdown()
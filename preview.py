@@ -1,16 +1,23 @@
 # Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
 # SPDX-License-Identifier: MIT
 
+import collections
+import concurrent.futures
 import io
-import picamera
 import pygame
 import queue
 import threading
 import time
-from PIL import Image, ImageDraw, ImageFont
+import weakref
+from PIL import Image, ImageDraw, ImageFilter, ImageFont, ImageStat
 
 import activity
+import album
+import decode
+import layout
+import tracing
 
+from backend import picamera
 from consts import SHUTTER_BUTTON, QUAD_BUTTON, PLAY_BUTTON
 
 def LoadImg(filename):
@@ -26,6 +33,7 @@ def align_size(size):
 class Overlay():
     def __init__(self, camera, size, filename = None, color = (0, 0, 0)):
         padded_size = align_size(size)
+        self.background = color
         self.pimg = Image.new('RGB', (padded_size[0], padded_size[1]), color)
         self.ovl = camera.add_overlay(self.pimg.tobytes(), format='rgb', size=self.pimg.size)
         self.z = 3
@@ -71,9 +79,15 @@ class Overlay():
         self.ovl.update(content)
 
     def from_file(self, filename, resize = False):
-        png = Image.open(filename)
+        if resize:
+            self.from_image(decode.open_scaled(filename, self.pimg.size), resize)
+        else:
+            self.from_image(Image.open(filename), resize)
+
+    def from_image(self, png, resize = False):
         if resize:
             png.thumbnail(self.pimg.size)
+        self.pimg.paste(self.background, (0, 0, self.pimg.size[0], self.pimg.size[1]))
         if png.mode == 'RGBA':
             self.pimg.paste(png, (int((self.pimg.size[0] - png.size[0]) / 2), int((self.pimg.size[1] - png.size[1]) / 2)), png)
         else:
@@ -83,7 +97,8 @@ class Overlay():
 class AlphaOverlay(Overlay):
     def __init__(self, camera, size, filename = None):
         padded_size = align_size(size)
-        self.pimg = Image.new('RGBA', (padded_size[0], padded_size[1]), (0, 0, 0, 0))
+        self.background = (0, 0, 0, 0)
+        self.pimg = Image.new('RGBA', (padded_size[0], padded_size[1]), self.background)
         self.ovl = camera.add_overlay(self.pimg.tobytes(), format='rgba', size=self.pimg.size)
         self.z = 3
         self.alpha = 255
@@ -92,17 +107,132 @@ class AlphaOverlay(Overlay):
             self.from_file(filename)
         self.hide()
 
+# Overlays are allocated once and then only ever re-used, so that showing
+# one doesn't have to wait for a new MMAL layer to be set up.
+class OverlayPool():
+    def __init__(self):
+        self.overlays = []
+
+    def add(self, overlay):
+        self.overlays.append(overlay)
+        return overlay
+
+    def hide(self):
+        for ovl in self.overlays:
+            ovl.hide()
+
+    def close(self):
+        for ovl in self.overlays:
+            ovl.close()
+        self.overlays = []
+
+# Reusable buffer which the camera writes a raw capture into. Frames
+# handed out by CaptureThread are views onto it, and it goes back to the
+# pool once the last view is gone.
+class FrameBuffer():
+    def __init__(self, length):
+        self.buf = bytearray(length)
+        self.view = memoryview(self.buf)
+        self.pos = 0
+
+    def write(self, data):
+        n = len(data)
+        self.view[self.pos:self.pos + n] = data
+        self.pos += n
+        return n
+
+    def flush(self):
+        pass
+
+    def reset(self):
+        self.pos = 0
+
+# Keeps the last few frames from an MJPEG recording, so that a still can
+# be picked from frames which were already captured when the shutter was
+# pressed.
+class FrameRing():
+    def __init__(self, maxframes, latency = 0.0):
+        self.lock = threading.Condition()
+        self.frames = collections.deque(maxlen=maxframes)
+        self.partial = []
+        # Delay between a frame being exposed and it arriving here
+        self.latency = latency
+
+    def write(self, data):
+        self.partial.append(bytes(data))
+        # The encoder doesn't always hand over a whole frame at once
+        if data[-2:] == b'\xff\xd9':
+            frame = b''.join(self.partial)
+            self.partial = []
+            with self.lock:
+                self.frames.append((time.time() - self.latency, frame))
+                self.lock.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+        self.partial = []
+
+    @staticmethod
+    def sharpness(frame):
+        img = Image.open(io.BytesIO(frame))
+        img.draft('L', (160, 120))
+        edges = img.convert('L').filter(ImageFilter.FIND_EDGES)
+        return ImageStat.Stat(edges).var[0]
+
+    # The frame closest to when. With a window, the sharpest of the
+    # frames within window seconds of when is picked instead, to avoid
+    # motion blur.
+    def select(self, when, window = 0.0, timeout = 0.5):
+        with self.lock:
+            # Wait for the frames after 'when' to arrive too
+            deadline = time.time() + timeout
+            while len(self.frames) == 0 or self.frames[-1][0] < when + window:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            frames = list(self.frames)
+
+        if len(frames) == 0:
+            return None
+
+        frames.sort(key=lambda f: abs(f[0] - when))
+        candidates = [f for f in frames if abs(f[0] - when) <= window]
+        if len(candidates) < 2:
+            return frames[0][1]
+        return max(candidates, key=lambda f: FrameRing.sharpness(f[1]))[1]
+
 class CaptureThread(threading.Thread):
-    def __init__(self, camera):
+    def __init__(self, camera, nbuffers = 5):
         threading.Thread.__init__(self)
         self.camera = camera
         self.exit = threading.Event()
-        self.shutter_sem = threading.Semaphore(value=0)
+        self.requests = queue.Queue()
         self.frame_sem = threading.Semaphore(value=0)
         self.frame_queue = queue.Queue(maxsize=4)
+        self.nbuffers = nbuffers
+        self.buffers = queue.Queue()
+        self.buffer_size = None
 
-    def takePhoto(self):
-        self.shutter_sem.release()
+    # With encoded=True the camera's JPEG encoder is used, and the frame
+    # is returned still encoded (see album.encoded()).
+    def takePhoto(self, encoded = False):
+        self.requests.put(('still', encoded))
+
+    # Pick the frame from ring closest to when, returned encoded
+    def takeFromRing(self, ring, when, window = 0.0):
+        self.requests.put(('ring', ring, when, window))
+
+    # Grab up to count JPEG frames from the video port, interval seconds
+    # apart, stopping early if they'd take more than max_bytes. The
+    # result is a list of bytes.
+    def takeBurst(self, count, size, max_bytes, interval = 0):
+        self.requests.put(('burst', count, size, max_bytes, interval))
 
     def getPhoto(self, blocking=True):
         try:
@@ -113,15 +243,100 @@ class CaptureThread(threading.Thread):
     def stop(self):
         self.exit.set()
 
+    def getBuffer(self):
+        padded = align_size(self.camera.resolution)
+        length = padded[0] * padded[1] * 4
+        if length != self.buffer_size:
+            # Resolution changed, the pooled buffers are no use any more
+            self.buffers = queue.Queue()
+            self.buffer_size = length
+
+        try:
+            buf = self.buffers.get_nowait()
+        except queue.Empty:
+            buf = FrameBuffer(length)
+        buf.reset()
+        return buf
+
+    def putBuffer(self, buffers, buf):
+        if buffers is self.buffers and buffers.qsize() < self.nbuffers:
+            buffers.put(buf)
+
+    def captureRaw(self):
+        buf = self.getBuffer()
+        with tracing.span('capture.raw'):
+            self.camera.capture(buf, 'rgba')
+
+        # Map the padded buffer directly, using the stride to skip the
+        # padding rather than cropping a copy.
+        with tracing.span('capture.frombuffer'):
+            padded = align_size(self.camera.resolution)
+            im = Image.frombuffer('RGBA', self.camera.resolution,
+                        buf.buf, 'raw', 'RGBA', padded[0] * 4, 1)
+            weakref.finalize(im, self.putBuffer, self.buffers, buf)
+        return im
+
+    def captureEncoded(self):
+        stream = io.BytesIO()
+        with tracing.span('capture.jpeg'):
+            self.camera.capture(stream, 'jpeg')
+        im = Image.open(stream)
+        im.encoded = stream.getbuffer()
+        return im
+
+    def captureFromRing(self, ring, when, window):
+        with tracing.span('capture.ring'):
+            frame = ring.select(when, window)
+        if frame is None:
+            print("No frames in the ring, falling back to a still")
+            return self.captureEncoded()
+
+        im = Image.open(io.BytesIO(frame))
+        im.encoded = frame
+        return im
+
+    def captureBurst(self, count, size, max_bytes, interval):
+        frames = []
+        total = 0
+        stream = io.BytesIO()
+        due = None
+        with tracing.span('capture.burst'):
+            for _ in self.camera.capture_continuous(stream, 'jpeg', use_video_port=True, resize=size):
+                data = stream.getvalue()
+                stream.seek(0)
+                stream.truncate()
+                # Drop frames which come in before the next one is due.
+                # Due times step by interval, so the average spacing
+                # matches even though each frame is a little late.
+                now = time.time()
+                if due is not None and now < due:
+                    continue
+                due = now + interval if due is None else due + interval
+                if total + len(data) > max_bytes:
+                    print("Burst hit its memory cap after {} frames".format(len(frames)))
+                    break
+                frames.append(data)
+                total += len(data)
+                if len(frames) >= count:
+                    break
+        return frames
+
     def run(self):
         while not self.exit.is_set():
-            if self.shutter_sem.acquire(timeout=0.5):
-                stream = io.BytesIO()
-                self.camera.capture(stream, 'rgba')
-                im = Image.frombuffer('RGBA', align_size(self.camera.resolution),
-                            stream.getbuffer(), 'raw', 'RGBA', 0, 1)
-                im = im.crop((0, 0, self.camera.resolution[0], self.camera.resolution[1]))
-                self.frame_queue.put(im)
+            try:
+                request = self.requests.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            if request[0] == 'burst':
+                im = self.captureBurst(*request[1:])
+            elif request[0] == 'ring':
+                im = self.captureFromRing(*request[1:])
+            elif request[1]:
+                im = self.captureEncoded()
+            else:
+                im = self.captureRaw()
+            self.frame_queue.put(im)
 
 class PreviewActivity(activity.Activity):
     NONE = 0
@@ -130,8 +345,43 @@ class PreviewActivity(activity.Activity):
     REPEATSHUTTER = 3
     REVIEW = 4
 
-    def __init__(self, cosmic, screen, screen_resolution, resolution, preview_resolution, album, flash):
+    # Selected in turn with QUAD_BUTTON
+    MODES = ['single', 'quad', 'burst']
+
+    # Times after startCountdown() of each countdown substate change
+    COUNTDOWN_STEPS = [0.8, 1.0, 1.8, 2.0, 2.8, 3.0]
+
+    FONT = "/usr/share/fonts/truetype/freefont/FreeSansBold.ttf"
+    FONT_SIZE = 28
+
+    # How long after the preview starts to load the deferred assets
+    IDLE_LOAD = 1.0
+
+    # The QUAD LED is lit for quad mode, and blinks with this period for
+    # burst mode.
+    BLINK_PERIOD = 0.5
+
+    def __init__(self, cosmic, screen, screen_resolution, resolution, preview_resolution, album, flash,
+            assets, encode_single = False, quad_layout = '2x2',
+            burst_frames = 12, burst_size = (640, 480), burst_max_bytes = 16 * 1024 * 1024,
+            burst_interval = 0.1, zero_lag = False, zero_lag_frames = 12, zero_lag_window = 0.0,
+            attract_timeout = None):
         self.flash = flash
+        # Seconds without input before switching to the slideshow
+        self.attract_timeout = attract_timeout
+        self.active = time.time()
+        self.layout = layout.TEMPLATES[quad_layout]
+        self.burst_frames = burst_frames
+        self.burst_size = burst_size
+        self.burst_max_bytes = burst_max_bytes
+        self.burst_interval = burst_interval
+        self.ring = None
+        if zero_lag:
+            self.ring = FrameRing(zero_lag_frames, latency=1.0 / 24)
+        self.zero_lag_window = zero_lag_window
+        self.collage = None
+        self.session = None
+        self.encode_single = encode_single
         self.album = album
         self.screen = screen
         self.cosmic = cosmic
@@ -146,20 +396,12 @@ class PreviewActivity(activity.Activity):
         self.preview_resolution = preview_resolution
         self.capture_thread = CaptureThread(self.camera)
         self.capture_thread.start()
-        self.covl = None
-        self.shovl = None
-        self.efovl = None
-        self.revovl = None
-        self.quad = False
+        self.overlays = OverlayPool()
+        self.mode = PreviewActivity.MODES[0]
+        self.pending = []
 
         self.shots = 0
 
-        self.images = {
-                '3': LoadImg('3.png'),
-                '2': LoadImg('2.png'),
-                '1': LoadImg('1.png'),
-        }
-
         self.effect = 0
         self.effects = [
             # name,        image_effect,  image_effect_params, color_effects
@@ -176,77 +418,160 @@ class PreviewActivity(activity.Activity):
             ['Film',       'film',        [50, 130, 120],      None],
             ['Sepia',      'none',        None,                [100, 150]],
         ]
-        font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSansBold.ttf", 28)
-        for e in self.effects:
-            if len(e[0]) == 0:
-                e.append(None)
-                continue
-            string = "Effect: " + e[0]
+
+        # Countdown digits and effect labels are loaded on first use, or
+        # shortly after the preview first starts, whichever is sooner.
+        self.assets = assets
+        self.font = None
+        self.resumed = time.time()
+        self.images = None
+        self.covl = None
+        self.efovl = None
+
+        self.shovl = self.overlays.add(Overlay(self.camera, self.preview_resolution, color='white'))
+        self.revovl = self.overlays.add(Overlay(self.camera, self.preview_resolution))
+
+
+    def renderLabel(self, string):
+        if self.font is None:
+            self.font = ImageFont.truetype(PreviewActivity.FONT, PreviewActivity.FONT_SIZE)
+        font = self.font
+
+        if hasattr(font, 'getbbox'):
+            # getsize() is gone from Pillow 10
+            bbox = font.getbbox(string)
+            fontsize = (bbox[2], bbox[3])
+        else:
             fontsize = font.getsize(string)
-            size = align_size(fontsize)
-            txt = Image.new('RGBA', size, (0, 0, 0, 0))
-            d = ImageDraw.Draw(txt)
-            x = (size[0] - fontsize[0]) / 2
-            y = (size[1] - fontsize[1]) / 2
-            d.text((x-1, y-1), string, font=font, fill=(0, 0, 0, 200))
-            d.text((x+1, y-1), string, font=font, fill=(0, 0, 0, 200))
-            d.text((x-1, y+1), string, font=font, fill=(0, 0, 0, 200))
-            d.text((x+1, y+1), string, font=font, fill=(0, 0, 0, 200))
-            d.text((x, y), string, font=font, fill=(255, 255, 255, 200))
-            e.append(txt)
+        size = align_size(fontsize)
+        txt = Image.new('RGBA', size, (0, 0, 0, 0))
+        d = ImageDraw.Draw(txt)
+        x = (size[0] - fontsize[0]) / 2
+        y = (size[1] - fontsize[1]) / 2
+        d.text((x-1, y-1), string, font=font, fill=(0, 0, 0, 200))
+        d.text((x+1, y-1), string, font=font, fill=(0, 0, 0, 200))
+        d.text((x-1, y+1), string, font=font, fill=(0, 0, 0, 200))
+        d.text((x+1, y+1), string, font=font, fill=(0, 0, 0, 200))
+        d.text((x, y), string, font=font, fill=(255, 255, 255, 200))
+        return txt
+
+    def loadCountdown(self):
+        if self.images is not None:
+            return
 
+        with tracing.span('startup.countdown'):
+            images = {}
+            for k in ['3', '2', '1']:
+                filename = '{}.png'.format(k)
+                images[k] = self.assets.image(('countdown', self.assets.fileKey(filename)),
+                        lambda: LoadImg(filename))
+            self.countdown_size = images['3'].size
+            self.images = { k: v.tobytes() for k, v in images.items() }
+
+            self.covl = self.overlays.add(AlphaOverlay(self.camera, self.countdown_size))
+            self.covl.window((
+                int((self.screen_resolution[0] - self.covl.size()[0]) / 2),
+                int((self.screen_resolution[1] - self.covl.size()[1]) / 2),
+                int(self.covl.size()[0]),
+                int(self.covl.size()[1]),
+            ))
+
+    def loadLabels(self):
+        if self.efovl is not None:
+            return
+
+        with tracing.span('startup.labels'):
+            font_key = (self.assets.fileKey(PreviewActivity.FONT), PreviewActivity.FONT_SIZE)
+            labels = []
+            for e in self.effects:
+                if len(e[0]) == 0:
+                    labels.append(None)
+                    continue
+                string = "Effect: " + e[0]
+                labels.append(self.assets.image(('label', font_key, string),
+                        lambda: self.renderLabel(string)))
+
+            # Pad all the labels to the same size, so they can share an overlay
+            sizes = [l.size for l in labels if l is not None]
+            self.label_size = (max(s[0] for s in sizes), max(s[1] for s in sizes))
+            for e, label in zip(self.effects, labels):
+                if label is None:
+                    e.append(None)
+                    continue
+                txt = Image.new('RGBA', self.label_size, (0, 0, 0, 0))
+                txt.paste(label, (int((self.label_size[0] - label.size[0]) / 2),
+                        int((self.label_size[1] - label.size[1]) / 2)))
+                e.append(txt.tobytes())
+
+            self.efovl = self.overlays.add(AlphaOverlay(self.camera, self.label_size))
+            self.efovl.window((
+                int((self.screen_resolution[0] - self.efovl.size()[0]) / 2),
+                int(self.screen_resolution[1] / 20),
+                int(self.efovl.size()[0]),
+                int(self.efovl.size()[1]),
+            ))
 
     def onResume(self):
         self.flash.on()
         self.screen.fill((0, 0, 0))
         pygame.display.flip()
         self.camera.start_preview(resolution=self.preview_resolution)
+        if self.ring is not None:
+            self.ring.clear()
+            self.camera.start_recording(self.ring, format='mjpeg', splitter_port=2)
         self.setEffect(self.effect)
+        self.resumed = time.time()
+        self.modeLed(self.resumed)
+        self.active = self.resumed
 
     def onPause(self):
         self.flash.off()
         self.stopCountdown()
         self.stopShutter()
-        if self.efovl is not None:
-            self.efovl.close()
-            self.efovl = None
+        # Writes carry on in the background: the player hears about new
+        # files from the album, so there's no need to wait for them here.
+        self.overlays.hide()
+        if self.ring is not None:
+            self.camera.stop_recording(splitter_port=2)
         self.camera.stop_preview()
 
     def onExit(self):
         self.capture_thread.stop()
         self.capture_thread.join()
         self.onPause()
+        self.waitPending()
+        self.overlays.close()
 
     def setEffect(self, effect):
-        if effect < 0:
-            effect += len(self.effects)
-        elif effect >= len(self.effects):
-            effect -= len(self.effects)
-        self.effect = effect
+        self.effect = effect % len(self.effects)
         effect = self.effects[self.effect]
         self.camera.image_effect = effect[1]
         self.camera.color_effects = effect[3]
         if effect[2] is not None:
             self.camera.image_effect_params = effect[2]
 
-        if self.efovl is not None:
-            self.efovl.close()
-            self.efovl = None
-
-        if effect[-1] is not None:
-            img = effect[-1]
-            self.efovl = AlphaOverlay(self.camera, img.size)
-            self.efovl.hide()
-            self.efovl.window((
-                int((self.screen_resolution[0] - img.size[0]) / 2),
-                int(self.screen_resolution[1] / 20),
-                int(img.size[0]),
-                int(img.size[1]),
-            ))
-            self.efovl.set_content(img.tobytes())
+        if len(effect[0]) > 0:
+            self.loadLabels()
+            self.efovl.set_content(effect[4])
             self.efovl.show()
+        elif self.efovl is not None:
+            self.efovl.hide()
+
+    def attractDue(self):
+        if self.attract_timeout is None or not self.idle():
+            return False
+        now = time.time()
+        if now < self.active + self.attract_timeout:
+            return False
+        if len(self.album.list()) == 0:
+            # Nothing to show, check again later
+            self.active = now
+            return False
+        return True
 
     def onInputReceived(self, events):
+        if len(events) > 0:
+            self.active = time.time()
         for event in events:
             if 'button' in event and event['button'] == SHUTTER_BUTTON:
                 if self.state == PreviewActivity.COUNTDOWN:
@@ -255,8 +580,9 @@ class PreviewActivity(activity.Activity):
                     self.startCountdown()
             elif 'button' in event and event['button'] == QUAD_BUTTON:
                 if self.state == PreviewActivity.NONE:
-                    self.quad = not(self.quad)
-                    self.cosmic.led(QUAD_BUTTON).set(self.quad)
+                    self.mode = PreviewActivity.MODES[(PreviewActivity.MODES.index(self.mode) + 1) %
+                            len(PreviewActivity.MODES)]
+                    self.modeLed(time.time())
             elif 'button' in event and event['button'] == PLAY_BUTTON:
                 if self.state == PreviewActivity.NONE:
                     return 'player'
@@ -265,26 +591,63 @@ class PreviewActivity(activity.Activity):
                     return 'player'
             elif 'encoder' in event:
                 if self.state == PreviewActivity.NONE:
-                    effect = self.effect + event['encoder']
+                    effect = self.effect + event.get('detents', event['encoder'])
                     self.setEffect(effect)
-            return None
+        if self.attractDue():
+            return 'slideshow'
+        return None
+
+    def nextDeadline(self):
+        if self.state == PreviewActivity.COUNTDOWN:
+            return self.time + PreviewActivity.COUNTDOWN_STEPS[min(self.substate, 5)]
+        elif self.state == PreviewActivity.SHUTTER:
+            # Fading the flash, and waiting for the capture
+            return time.time() + activity.FRAME_PERIOD
+        elif self.state == PreviewActivity.REPEATSHUTTER:
+            return self.time + 0.8
+        elif self.state == PreviewActivity.REVIEW:
+            return self.time + self.substate
+
+        deadlines = []
+        if not self.assetsLoaded():
+            deadlines.append(self.resumed + PreviewActivity.IDLE_LOAD)
+        elif self.attract_timeout is not None:
+            deadlines.append(self.active + self.attract_timeout)
+        if self.mode == 'burst':
+            period = PreviewActivity.BLINK_PERIOD
+            deadlines.append(self.resumed + (int((time.time() - self.resumed) / period) + 1) * period)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def modeLed(self, now):
+        lit = self.mode != 'single'
+        if self.mode == 'burst':
+            lit = int((now - self.resumed) / PreviewActivity.BLINK_PERIOD) % 2 == 0
+        self.cosmic.led(QUAD_BUTTON).set(lit)
+
+    def idle(self):
+        return self.state == PreviewActivity.NONE and self.assetsLoaded()
+
+    def assetsLoaded(self):
+        return self.images is not None and self.efovl is not None
 
     def onDraw(self):
         now = time.time()
         since = now - self.time
+        # startShutter() resets self.time, so keep the countdown's start
+        state, substate, start = self.state, self.substate, self.time
         if self.state == PreviewActivity.COUNTDOWN:
             if self.substate == 0 and since > 0.8:
                 self.cosmic.led(SHUTTER_BUTTON).off()
                 self.substate = 1
             elif self.substate == 1 and since > 1.0 :
-                self.covl.set_content(self.images['2'].tobytes())
+                self.covl.set_content(self.images['2'])
                 self.cosmic.led(SHUTTER_BUTTON).on()
                 self.substate = 2
             elif self.substate == 2 and since > 1.8:
                 self.cosmic.led(SHUTTER_BUTTON).off()
                 self.substate = 3
             elif self.substate == 3 and since > 2.0:
-                self.covl.set_content(self.images['1'].tobytes())
+                self.covl.set_content(self.images['1'])
                 self.cosmic.led(SHUTTER_BUTTON).on()
                 self.substate = 4
             elif self.substate == 4 and since > 2.8:
@@ -309,10 +672,27 @@ class PreviewActivity(activity.Activity):
         elif self.state == PreviewActivity.REVIEW:
             if since >= self.substate:
                 self.stopReview()
-
-    def startReview(self, filename, seconds):
-            self.revovl = Overlay(self.camera, self.preview_resolution)
-            self.revovl.from_file(filename, True)
+        elif self.state == PreviewActivity.NONE:
+            if not self.assetsLoaded() and now >= self.resumed + PreviewActivity.IDLE_LOAD:
+                self.loadCountdown()
+                self.loadLabels()
+            if self.mode == 'burst':
+                self.modeLed(now)
+
+        if state == PreviewActivity.COUNTDOWN and substate != self.substate:
+            tracing.record('countdown.{}'.format(substate), start + (0 if substate == 0 else
+                    PreviewActivity.COUNTDOWN_STEPS[substate - 1]), now)
+
+        self.pending = [f for f in self.pending if not f.done()]
+
+    def waitPending(self):
+        concurrent.futures.wait(self.pending)
+        self.pending = []
+
+    def startReview(self, image, seconds):
+            with tracing.span('review.load'):
+                self.revovl.from_image(image, True)
+                image.close()
             self.revovl.show()
 
             self.screen.fill((255, 255, 255))
@@ -324,34 +704,33 @@ class PreviewActivity(activity.Activity):
     def stopReview(self):
         self.screen.fill((0, 0, 0))
         pygame.display.flip()
-        self.revovl.close()
-        self.revovl = None
+        self.revovl.hide()
         self.state = PreviewActivity.NONE
 
     def stopCountdown(self):
         self.state = PreviewActivity.NONE
         if self.covl is not None:
-            self.covl.close()
-            self.covl = None
+            self.covl.hide()
         self.cosmic.led(SHUTTER_BUTTON).off()
 
     def startCountdown(self):
         self.state = PreviewActivity.COUNTDOWN
         self.substate = 0
         self.time = time.time()
-        if self.quad:
-            self.shots = 4
+        self.session = tracing.beginSession(self.time)
+        self.frames = []
+        self.collage = None
+        if self.mode == 'quad':
+            self.shots = len(self.layout)
         else:
             self.shots = 1
-        self.frames = []
-        self.covl = AlphaOverlay(self.camera, self.images['3'].size)
-        self.covl.window((
-            int((self.screen_resolution[0] - self.covl.size()[0]) / 2),
-            int((self.screen_resolution[1] - self.covl.size()[1]) / 2),
-            int(self.covl.size()[0]),
-            int(self.covl.size()[1]),
-        ))
-        self.covl.set_content(self.images['3'].tobytes())
+        # Allocate the canvas now, ready for the frames to go straight in.
+        # With post-processing, the album needs the separate frames
+        # instead, so it can process them in parallel.
+        if self.mode == 'quad' and self.album.postprocess is None:
+            self.collage = layout.Collage(self.layout, tuple(self.camera.resolution))
+        self.loadCountdown()
+        self.covl.set_content(self.images['3'])
         self.covl.show()
         self.cosmic.led(SHUTTER_BUTTON).on()
 
@@ -360,14 +739,20 @@ class PreviewActivity(activity.Activity):
         if im is None:
             return
 
-        self.frames.append(im)
+        if isinstance(im, list):
+            self.stopBurst(im)
+            return
+
+        if self.collage is not None:
+            self.collage.add(im)
+            im.close()
+        else:
+            self.frames.append(im)
 
         self.state = PreviewActivity.NONE
         self.cosmic.led(SHUTTER_BUTTON).off()
 
-        if self.shovl is not None:
-            self.shovl.close()
-            self.shovl = None
+        self.shovl.hide()
 
         self.shots = self.shots - 1
         if self.shots > 0:
@@ -375,20 +760,51 @@ class PreviewActivity(activity.Activity):
         else:
             # Hack: Longer review for quads
             revtime = 2.0
-            if len(self.frames) == 4:
+            if self.mode == 'quad':
                 revtime = 4.0
-
-            filename = self.album.writeOut(self.frames)
+            if self.collage is not None:
+                self.frames = [self.collage.result()]
+                self.collage = None
+
+            # Review the in-memory frames straight away, the full-size
+            # encode happens in the background.
+            review = album.preview(self.frames, self.preview_resolution, self.layout)
+            self.pending.append(self.album.submit(self.frames,
+                    callback=lambda f, s=self.session: tracing.endSession(s), template=self.layout))
             self.frames = None
-            self.startReview(filename, revtime)
+            self.startReview(review, revtime)
+
+    def stopBurst(self, frames):
+        self.state = PreviewActivity.NONE
+        self.cosmic.led(SHUTTER_BUTTON).off()
+        self.shovl.hide()
+        self.shots = 0
+
+        if len(frames) == 0:
+            print("Burst captured no frames")
+            return
+
+        review = decode.reduce(Image.open(io.BytesIO(frames[0])), self.preview_resolution)
+        self.pending.append(self.album.submitAnimation(frames, self.burst_interval,
+                callback=lambda f, s=self.session: tracing.endSession(s)))
+        self.startReview(review, 3.0)
 
     def startShutter(self):
         self.state = PreviewActivity.SHUTTER
         self.cosmic.led(SHUTTER_BUTTON).on()
         self.time = time.time()
-        self.shovl = Overlay(self.camera, self.preview_resolution, color='white')
+        self.shovl.set_alpha(255)
         self.shovl.show()
         self.takePhoto()
 
     def takePhoto(self):
-        self.capture_thread.takePhoto()
+        # Single shots don't need compositing, so can use the hardware
+        # JPEG encoder directly.
+        if self.mode == 'burst':
+            self.capture_thread.takeBurst(self.burst_frames, self.burst_size, self.burst_max_bytes,
+                    self.burst_interval)
+        elif self.ring is not None:
+            # The flash has just gone up: that's the moment to keep
+            self.capture_thread.takeFromRing(self.ring, self.time, self.zero_lag_window)
+        else:
+            self.capture_thread.takePhoto(encoded=(self.encode_single and self.mode == 'single'))
@@ -0,0 +1,45 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+import pygame
+
+# Tracks what each region of the screen is showing, so that only regions
+# whose content has changed get redrawn and pushed to the display.
+class Renderer():
+    def __init__(self, screen):
+        self.screen = screen
+        self.slots = {}
+        self.damage = []
+
+    def shows(self, slot, key):
+        return self.slots.get(slot) == key
+
+    def blit(self, slot, key, surface, rect):
+        if self.shows(slot, key):
+            return
+        self.slots[slot] = key
+        self.damage.append(self.screen.blit(surface, rect))
+
+    def fill(self, slot, key, color, rect = None):
+        if slot is not None:
+            if self.shows(slot, key):
+                return
+            self.slots[slot] = key
+        self.damage.append(self.screen.fill(color, rect))
+
+    # For anything drawn to the screen directly
+    def damaged(self, rect):
+        self.damage.append(pygame.Rect(rect))
+
+    def invalidate(self):
+        self.slots = {}
+        self.damage = [self.screen.get_rect()]
+
+    def flush(self):
+        if len(self.damage) == 0:
+            return
+        if self.screen.get_rect() in self.damage:
+            pygame.display.update()
+        else:
+            pygame.display.update(self.damage)
+        self.damage = []
@@ -0,0 +1,190 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import tracing
+
+def checksum(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.digest()
+
+def fsync(path, directory = False):
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Copies files from source to destination in the background. Pending
+# copies are journalled, so anything outstanding after a crash or
+# power cut is picked up again on the next start. Copies are verified
+# against the source, and synced to the destination in batches - a
+# file is only marked done in the journal once it's safely on disk.
+class Replicator():
+    def __init__(self, source, destination, journal, batch = 8, interval = 5.0, max_backoff = 60.0):
+        self.source = os.path.abspath(source)
+        self.destination = os.path.abspath(destination)
+        self.journal_path = journal
+        self.batch = batch
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.cond = threading.Condition()
+        self.exit = False
+        # name -> [time queued, attempts, not before]
+        self.pending = {}
+
+        self.recover()
+        self.journal = open(self.journal_path, 'a')
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def recover(self):
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    words = line.split()
+                    if len(words) >= 2 and words[0] == 'add':
+                        queued = float(words[2]) if len(words) > 2 else time.time()
+                        self.pending[words[1]] = [queued, 0, 0]
+                    elif len(words) >= 2 and words[0] == 'done':
+                        self.pending.pop(words[1], None)
+        except FileNotFoundError:
+            pass
+
+        # Compact the journal down to what's still outstanding
+        with open(self.journal_path + '.tmp', 'w') as f:
+            for name, (queued, attempts, not_before) in self.pending.items():
+                f.write("add {} {}\n".format(name, queued))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+
+        if len(self.pending) > 0:
+            print("Resuming replication of {} files".format(len(self.pending)))
+
+    def enqueue(self, filename):
+        name = os.path.relpath(os.path.abspath(filename), self.source)
+        with self.cond:
+            now = time.time()
+            self.journal.write("add {} {}\n".format(name, now))
+            self.journal.flush()
+            self.pending[name] = [now, 0, 0]
+            self.cond.notify()
+
+    # (files outstanding, age in seconds of the oldest one)
+    def lag(self):
+        with self.cond:
+            if len(self.pending) == 0:
+                return (0, 0.0)
+            return (len(self.pending), time.time() - min(p[0] for p in self.pending.values()))
+
+    def copy(self, name):
+        src = os.path.join(self.source, name)
+        dst = os.path.join(self.destination, name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+        tmp = dst + '.tmp'
+        shutil.copy2(src, tmp)
+        if checksum(tmp) != checksum(src):
+            os.unlink(tmp)
+            raise OSError("checksum mismatch")
+        os.replace(tmp, dst)
+        return dst
+
+    def next(self):
+        now = time.time()
+        ready = [(p[0], name) for name, p in self.pending.items() if p[2] <= now]
+        return [name for queued, name in sorted(ready)[:self.batch]]
+
+    def syncDue(self, copied, last_sync):
+        return len(copied) > 0 and (len(copied) >= self.batch or self.exit or
+                time.time() - last_sync >= self.interval)
+
+    def timeout(self, copied, last_sync):
+        now = time.time()
+        wake = now + self.interval
+        if len(copied) > 0:
+            wake = min(wake, last_sync + self.interval)
+        for queued, attempts, not_before in self.pending.values():
+            wake = min(wake, not_before)
+        return max(0, wake - now)
+
+    def run(self):
+        copied = []
+        last_sync = time.time()
+        while True:
+            with self.cond:
+                names = self.next()
+                if len(names) == 0 and not self.syncDue(copied, last_sync):
+                    if self.exit:
+                        return
+                    self.cond.wait(self.timeout(copied, last_sync))
+                    continue
+
+            for name in names:
+                try:
+                    copied.append((name, self.copy(name)))
+                    with self.cond:
+                        # Done, bar the sync
+                        self.pending[name][2] = float('inf')
+                except OSError as e:
+                    with self.cond:
+                        if not os.path.exists(os.path.join(self.source, name)):
+                            print("Dropping {} from replication, it no longer exists".format(name))
+                            del self.pending[name]
+                            self.journal.write("done {}\n".format(name))
+                            self.journal.flush()
+                            continue
+
+                        p = self.pending[name]
+                        p[1] += 1
+                        p[2] = time.time() + min(self.max_backoff, 2 ** p[1])
+                    print("Replicating {} failed (attempt {}): {}".format(name, p[1], e))
+
+            if self.syncDue(copied, last_sync):
+                try:
+                    self.sync(copied)
+                except OSError as e:
+                    print("Syncing replicas failed: {}".format(e))
+                    with self.cond:
+                        for name, dst in copied:
+                            self.pending[name][2] = time.time() + self.interval
+                copied = []
+                last_sync = time.time()
+
+    def sync(self, copied):
+        if len(copied) == 0:
+            return
+
+        with tracing.span('replication.sync'):
+            directories = set()
+            for name, dst in copied:
+                fsync(dst)
+                directories.add(os.path.dirname(dst))
+            for d in directories:
+                fsync(d, directory=True)
+
+        now = time.time()
+        with self.cond:
+            for name, dst in copied:
+                tracing.record('replication.lag', self.pending[name][0], now)
+                del self.pending[name]
+                self.journal.write("done {}\n".format(name))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def close(self):
+        with self.cond:
+            self.exit = True
+            self.cond.notify()
+        self.thread.join()
+        self.journal.close()
@@ -0,0 +1,245 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+# Simulated stand-ins for RPi.GPIO and picamera, used when backend.py
+# selects the simulated backend.
+
+import io
+import threading
+import time
+from PIL import Image, ImageDraw
+
+class SimGPIO():
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    PUD_OFF = 20
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._levels = {}
+        self._callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, channel, direction, pull_up_down = None, initial = 0):
+        with self._lock:
+            if direction == SimGPIO.IN:
+                self._levels[channel] = 1 if pull_up_down == SimGPIO.PUD_UP else 0
+            else:
+                self._levels[channel] = initial
+
+    def input(self, channel):
+        with self._lock:
+            return self._levels.get(channel, 0)
+
+    def output(self, channel, level):
+        with self._lock:
+            self._levels[channel] = int(bool(level))
+
+    def add_event_detect(self, channel, edge, callback = None, bouncetime = None):
+        with self._lock:
+            self._callbacks.setdefault(channel, []).append((edge, callback))
+
+    def cleanup(self):
+        with self._lock:
+            self._levels = {}
+            self._callbacks = {}
+
+    # Scripting interface, drives inputs as if they were real edges
+
+    def set_level(self, channel, level):
+        with self._lock:
+            old = self._levels.get(channel, 0)
+            self._levels[channel] = level
+            callbacks = list(self._callbacks.get(channel, []))
+
+        if old == level:
+            return
+        for edge, callback in callbacks:
+            if callback is None:
+                continue
+            if edge == SimGPIO.BOTH or \
+                    (edge == SimGPIO.RISING and level == 1) or \
+                    (edge == SimGPIO.FALLING and level == 0):
+                callback(channel)
+
+    # Buttons are active-low, with pull-ups
+    def press(self, channel, hold = 0.1):
+        self.set_level(channel, 0)
+        time.sleep(hold)
+        self.set_level(channel, 1)
+
+    # Quadrature sequence for the encoder, one detent per step. Positive
+    # steps count up.
+    def turn(self, channel_a, channel_b, steps, interval = 0.01):
+        if steps > 0:
+            sequence = [(0, 1), (0, 0), (1, 0), (1, 1)]
+        else:
+            sequence = [(1, 0), (0, 0), (0, 1), (1, 1)]
+
+        for i in range(abs(steps)):
+            for a, b in sequence:
+                # Set both levels before either edge fires, as the real
+                # callbacks read both pins
+                with self._lock:
+                    self._levels[channel_a], old_a = a, self._levels.get(channel_a, 1)
+                    self._levels[channel_b], old_b = b, self._levels.get(channel_b, 1)
+                    callbacks = []
+                    if old_a != a:
+                        callbacks += self._callbacks.get(channel_a, [])
+                    if old_b != b:
+                        callbacks += self._callbacks.get(channel_b, [])
+                for edge, callback in callbacks:
+                    if callback is not None:
+                        callback(channel_a)
+            time.sleep(interval)
+
+GPIO = SimGPIO()
+
+# Runs a list of input actions against SimGPIO, one per line:
+#   press <pin> [hold seconds]
+#   turn <pin a> <pin b> <steps> [interval seconds]
+#   sleep <seconds>
+# Blank lines and lines starting with '#' are ignored.
+class Script(threading.Thread):
+    def __init__(self, gpio, path):
+        threading.Thread.__init__(self, daemon=True)
+        self.gpio = gpio
+        with open(path) as f:
+            self.lines = [l.split() for l in f]
+
+    def run(self):
+        for words in self.lines:
+            if len(words) == 0 or words[0].startswith('#'):
+                continue
+            cmd, args = words[0], words[1:]
+            if cmd == 'press':
+                self.gpio.press(int(args[0]), *[float(a) for a in args[1:]])
+            elif cmd == 'turn':
+                self.gpio.turn(int(args[0]), int(args[1]), int(args[2]),
+                        *[float(a) for a in args[3:]])
+            elif cmd == 'sleep':
+                time.sleep(float(args[0]))
+            else:
+                print("Unknown script command '{}'".format(cmd))
+
+class SimOverlay():
+    def __init__(self, camera, source, size, format):
+        self.camera = camera
+        self.size = tuple(size)
+        self.format = format
+        self.window = None
+        self.fullscreen = True
+        self.alpha = 255
+        self.layer = 0
+        self.updates = 0
+        self.update(source)
+
+    def update(self, source):
+        bpp = 4 if self.format in ('rgba', 'bgra') else 3
+        if len(source) != self.size[0] * self.size[1] * bpp:
+            raise ValueError("Overlay source is {} bytes, expected {}".format(
+                len(source), self.size[0] * self.size[1] * bpp))
+        self.updates += 1
+
+    def close(self):
+        self.camera.remove_overlay(self)
+
+# Enough of picamera.PiCamera for the booth: tracks overlays, and produces
+# synthetic frames with roughly the delays of the still port.
+class PiCamera():
+    def __init__(self):
+        self.resolution = (1640, 1232)
+        self.framerate = 24
+        self.hflip = False
+        self.image_effect = 'none'
+        self.image_effect_params = None
+        self.color_effects = None
+        self.overlays = []
+        self.preview = None
+        self.frame_count = 0
+        self.closed = False
+        self.recordings = {}
+
+    def add_overlay(self, source, size = None, format = None, **options):
+        ovl = SimOverlay(self, source, size, format)
+        self.overlays.append(ovl)
+        return ovl
+
+    def remove_overlay(self, overlay):
+        if overlay in self.overlays:
+            self.overlays.remove(overlay)
+
+    def start_preview(self, **options):
+        self.preview = options
+
+    def stop_preview(self):
+        self.preview = None
+
+    def captureDelay(self, use_video_port):
+        if use_video_port:
+            return 1.0 / self.framerate
+        # Mode switch plus readout, scaling with the sensor area
+        return 0.25 + self.resolution[0] * self.resolution[1] * 4e-8
+
+    def frame(self, size):
+        self.frame_count += 1
+        shade = (self.frame_count * 37) % 256
+        img = Image.new('RGB', size, (shade, 128, 255 - shade))
+        d = ImageDraw.Draw(img)
+        d.text((size[0] / 2, size[1] / 2), "{}".format(self.frame_count), fill=(255, 255, 255))
+        return img
+
+    def capture(self, output, format = 'jpeg', use_video_port = False, resize = None, **options):
+        time.sleep(self.captureDelay(use_video_port))
+        size = tuple(resize) if resize is not None else tuple(self.resolution)
+
+        img = self.frame(size)
+        if format in ('rgb', 'rgba'):
+            # Like the firmware, pad to a multiple of 32x16
+            padded = ((size[0] + 31) & ~0x1f, (size[1] + 15) & ~0xf)
+            canvas = Image.new(format.upper(), padded)
+            canvas.paste(img, (0, 0))
+            data = canvas.tobytes()
+        else:
+            stream = io.BytesIO()
+            img.save(stream, format)
+            data = stream.getvalue()
+
+        if isinstance(output, str):
+            with open(output, 'wb') as f:
+                f.write(data)
+        else:
+            output.write(data)
+            if hasattr(output, 'flush'):
+                output.flush()
+
+    def capture_continuous(self, output, format = 'jpeg', use_video_port = False, resize = None, **options):
+        while not self.closed:
+            self.capture(output, format, use_video_port, resize)
+            yield output
+
+    def start_recording(self, output, format = 'h264', splitter_port = 1, resize = None, **options):
+        stop = threading.Event()
+        def record():
+            while not stop.is_set():
+                self.capture(output, 'jpeg', True, resize)
+        thread = threading.Thread(target=record, daemon=True)
+        self.recordings[splitter_port] = (thread, stop)
+        thread.start()
+
+    def stop_recording(self, splitter_port = 1):
+        thread, stop = self.recordings.pop(splitter_port)
+        stop.set()
+        thread.join()
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,147 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+import pygame
+import time
+
+import activity
+import player
+
+from consts import QUAD_BUTTON, RENDITIONS
+
+# Attract mode: cycles through the album, newest first, cross-fading
+# from one picture to the next. Pictures are loaded ahead of time by the
+# player's cache, and each one is drawn into a back buffer before its
+# fade starts, so a frame never waits for a load. Between fades there's
+# nothing to do until the next switch, so it sleeps.
+class SlideshowActivity(activity.Activity):
+    FADE_FPS = 15
+
+    def __init__(self, cosmic, screen, screen_resolution, album, interval = 6.0, fade = 1.0,
+            cache_budget = 8 * 1024 * 1024):
+        self.cosmic = cosmic
+        self.screen = screen
+        self.screen_resolution = screen_resolution
+        self.album = album
+        self.interval = interval
+        self.fade = fade
+        self.cache_budget = cache_budget
+        self.files = []
+        self.cache = None
+        self.active = False
+
+        # front is on screen, back has the next picture (once ready)
+        self.front = pygame.Surface(screen_resolution).convert()
+        self.back = pygame.Surface(screen_resolution).convert()
+        self.idx = 0
+        self.ready = False
+        self.switch = 0
+        self.fading = None
+
+    def onResume(self):
+        self.active = True
+        # The preview lit (or was blinking) it for its capture mode, and
+        # puts it back when it resumes.
+        self.cosmic.led(QUAD_BUTTON).off()
+        self.files = self.album.list()
+        self.idx = 0
+        self.ready = False
+        self.fading = None
+        self.switch = time.time()
+
+        self.front.fill((0, 0, 0))
+        self.screen.blit(self.front, (0, 0))
+        pygame.display.update()
+
+        if len(self.files) == 0:
+            return
+        if self.cache is None:
+            self.cache = player.ImageCache(self.cache_budget, self.album, self.files, RENDITIONS['large'],
+                    RENDITIONS['small'], on_load=self.onLoaded)
+        else:
+            self.cache.setFiles(self.files)
+            self.cache.prefetch(self.idx, 1)
+
+    def onPause(self):
+        self.active = False
+
+    def onExit(self):
+        if self.cache is not None:
+            self.cache.close()
+
+    # Called from the cache's workers
+    def onLoaded(self, filename):
+        if self.active and not self.ready and filename == self.files[self.idx]:
+            self.cosmic.wake()
+
+    def loaded(self):
+        imgs = self.cache.peek(self.idx)
+        return imgs is not None and imgs[0] is not None
+
+    def prepare(self):
+        img = self.cache.peek(self.idx)[0]
+        self.back.fill((0, 0, 0))
+        self.back.blit(img, img.get_rect(center=self.back.get_rect().center))
+        self.ready = True
+
+    # Move on to the picture after idx, starting again from the newest
+    # (including anything taken since) at the end.
+    def advance(self):
+        self.idx += 1
+        if self.idx >= len(self.files):
+            self.files = self.album.list()
+            self.cache.setFiles(self.files)
+            self.idx = 0
+        self.ready = False
+        self.cache.prefetch(self.idx, 1)
+
+    def nextDeadline(self):
+        if len(self.files) == 0:
+            return time.time()
+        if self.fading is not None:
+            return time.time() + 1.0 / SlideshowActivity.FADE_FPS
+        if self.ready:
+            return self.switch
+        if self.loaded():
+            # Draw it into the back buffer now, not when the fade starts
+            return time.time()
+        # onLoaded() wakes us, but don't wait forever on one which fails
+        return self.switch + self.interval
+
+    def onDraw(self):
+        if len(self.files) == 0:
+            return
+
+        now = time.time()
+        if self.fading is None:
+            if not self.ready:
+                if self.loaded():
+                    self.prepare()
+                elif now >= self.switch + self.interval:
+                    print("Slideshow skipping {}".format(self.files[self.idx]))
+                    self.advance()
+                    self.switch = now
+                    return
+            if self.ready and now >= self.switch:
+                self.fading = now
+            else:
+                return
+
+        alpha = (now - self.fading) / self.fade
+        if alpha >= 1.0:
+            self.front, self.back = self.back, self.front
+            self.screen.blit(self.front, (0, 0))
+            self.fading = None
+            self.switch = now + self.interval
+            self.advance()
+        else:
+            self.screen.blit(self.front, (0, 0))
+            self.back.set_alpha(int(alpha * 255))
+            self.screen.blit(self.back, (0, 0))
+            self.back.set_alpha(None)
+        pygame.display.update()
+
+    def onInputReceived(self, events):
+        if len(self.files) == 0 or len(events) > 0:
+            return 'preview'
+        return None
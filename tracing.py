@@ -0,0 +1,140 @@
+# Copyright 2019-2020 Brian Starkey <stark3y@gmail.com>
+# SPDX-License-Identifier: MIT
+
+# Lightweight latency tracing. Stages are timed with span() or record(),
+# keeping a rolling window of durations per stage for percentiles, plus a
+# ring of raw events which can be dumped in Chrome trace format
+# (chrome://tracing, or ui.perfetto.dev) for the last few sessions.
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+class Tracer():
+    def __init__(self, window = 512, nevents = 8192, nsessions = 8):
+        self.lock = threading.Lock()
+        self.window = window
+        self.samples = {}
+        self.events = collections.deque(maxlen=nevents)
+        self.sessions = collections.deque(maxlen=nsessions)
+        self.directory = None
+        self.pid = os.getpid()
+
+    def configure(self, directory):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, stage, start, end = None):
+        if end is None:
+            end = time.time()
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = collections.deque(maxlen=self.window)
+                self.samples[stage] = samples
+            samples.append(end - start)
+            self.events.append(('X', stage, start, end, threading.get_ident()))
+
+    def mark(self, stage, when = None):
+        if when is None:
+            when = time.time()
+        with self.lock:
+            self.events.append(('i', stage, when, when, threading.get_ident()))
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, start)
+
+    # A session is one trip from shutter press to saved file. Only events
+    # inside the last few sessions go into the Chrome trace. Sessions can
+    # overlap, as files are saved in the background, so beginSession()
+    # returns the start, to be passed back to endSession().
+    def beginSession(self, when = None):
+        start = time.time() if when is None else when
+        self.mark('session', start)
+        return start
+
+    def endSession(self, start):
+        self.record('session', start)
+        with self.lock:
+            self.sessions.append((start, time.time()))
+        self.export()
+
+    # Most recent duration of each stage starting with prefix
+    def last(self, prefix):
+        with self.lock:
+            return [(k, v[-1]) for k, v in self.samples.items() if k.startswith(prefix) and len(v) > 0]
+
+    @staticmethod
+    def percentile(values, p):
+        idx = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+        return values[idx]
+
+    def metrics(self):
+        with self.lock:
+            samples = { k: sorted(v) for k, v in self.samples.items() }
+
+        metrics = {}
+        for stage, values in samples.items():
+            if len(values) == 0:
+                continue
+            metrics[stage] = {
+                'count': len(values),
+                'p50': self.percentile(values, 50),
+                'p95': self.percentile(values, 95),
+                'p99': self.percentile(values, 99),
+                'max': values[-1],
+            }
+        return metrics
+
+    def chromeTrace(self):
+        with self.lock:
+            events = list(self.events)
+            sessions = list(self.sessions)
+
+        trace = []
+        for ph, name, start, end, tid in events:
+            if not any(s[0] <= start <= s[1] for s in sessions):
+                continue
+            event = {
+                'name': name,
+                'ph': ph,
+                'ts': int(start * 1000000),
+                'pid': self.pid,
+                'tid': tid,
+            }
+            if ph == 'X':
+                event['dur'] = int((end - start) * 1000000)
+            else:
+                event['s'] = 't'
+            trace.append(event)
+        return { 'traceEvents': trace }
+
+    def export(self):
+        if self.directory is None:
+            return
+
+        for name, data in (('metrics.json', self.metrics()), ('trace.json', self.chromeTrace())):
+            path = os.path.join(self.directory, name)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(path + '.tmp', path)
+
+tracer = Tracer()
+
+configure = tracer.configure
+record = tracer.record
+mark = tracer.mark
+last = tracer.last
+span = tracer.span
+beginSession = tracer.beginSession
+endSession = tracer.endSession
+export = tracer.export